@@ -29,6 +29,9 @@ class JourneyCode(attributes.Numeric, attributes.ExactMatch):
     Internal code for a given journey. Matches only if exact.
 
     Possible values: positive integers."""
+
+    __slots__ = ()
+
     _weight = 100.0
 
 class HolidayType(attributes.TreeMatch):
@@ -41,6 +44,8 @@ class HolidayType(attributes.TreeMatch):
     Diving, Education, Language, Recreation, Shopping, Skiing,
     Surfing, Wandering."""
 
+    __slots__ = ()
+
     _match_tree = tree.Tree(
         ["Arbitrary", 0.3, [
                 ['Active', 0.5, [
@@ -71,6 +76,8 @@ class Price(attributes.LessIsPerfect, attributes.LinearAdjust):
 
     Possible values: Positive integers."""
 
+    __slots__ = ()
+
     # Price range in test cases is from 279-7161
     _range = [279.0, 7161.0]
     _weight = 5.0
@@ -83,6 +90,8 @@ class NumberOfPersons(attributes.LinearMatch, attributes.NumericAdapt):
 
     Possible values: Positive integers."""
 
+    __slots__ = ()
+
     # Range in test cases is from 1-12
     _range = [1.0, 12.0]
 
@@ -104,10 +113,13 @@ class Region(attributes.Attribute):
     lookup result is shown in parentheses when showing the
     attribute)."""
 
+    __slots__ = ()
+
     # Range for test cases is 0.001972-33.307608, or from Sweden to Egypt
     # The third item is the max direct distance
     _range = [0.001972, 33.307608, 4646.845297]
     _weight = 2.0
+    _interned = True
 
     def _set_value(self, value):
         """Convert a location value into a place"""
@@ -116,6 +128,14 @@ class Region(attributes.Attribute):
         else:
             self._value = place.Place(value)
 
+    def encode(self):
+        return [self.value.name, self.value.place_name,
+                list(self.value.coords) if self.value.coords is not None else None]
+
+    @classmethod
+    def decode(cls, data):
+        return cls.create(place.Place.from_location(*data))
+
     def similarity(self, other):
         latitude_part = self.scale(self.value.latitudal_distance(other.value),
                                    [self.value.coords[0], other.value.coords[0]])
@@ -123,6 +143,19 @@ class Region(attributes.Attribute):
         distance_part = distance/max([self._range[2], distance])
         return self.weight*(1.0-(latitude_part*0.9+distance_part*0.1))
 
+    def scorer(self):
+        """The similarity to each distinct place is only computed
+        once."""
+        if type(self).similarity is not Region.similarity:
+            return self.similarity
+        similarities = {}
+        def score(other):
+            place = other.value
+            if not place in similarities:
+                similarities[place] = self.similarity(other)
+            return similarities[place]
+        return score
+
     def __str__(self):
         place_name = self.value.place_name
 
@@ -135,6 +168,9 @@ class Transportation(attributes.TableMatch):
     table-based between the possible values.
 
     Possible values: Car, Coach, Train, Plane."""
+
+    __slots__ = ()
+
     _match_table = {'Car':   {'Car': 1.0, 'Coach': 0.8, 'Plane': 0.0, 'Train': 0.5,},
                     'Coach': {'Car': 0.6, 'Coach': 1.0, 'Plane': 0.0, 'Train': 0.8,},
                     'Plane': {'Car': 0.0, 'Coach': 0.0, 'Plane': 1.0, 'Train': 0.3,},
@@ -151,6 +187,8 @@ class Duration(attributes.LinearMatch, attributes.NumericAdapt):
 
     Possible values: Positive integers."""
 
+    __slots__ = ()
+
     # Range in test data is from 3-21
     _scale = 18.0
     _range = [3.0, 21.0]
@@ -164,6 +202,8 @@ class Season(attributes.Attribute):
 
     Possible values: Month names (January...December)."""
 
+    __slots__ = ()
+
     # Month names
     _months = ["January", "February", "March", "April", "May", "June",
                "July", "August", "September", "October", "November", "December"]
@@ -177,25 +217,39 @@ class Season(attributes.Attribute):
     _fuzz_similarity = 0.5
 
     _weight = 2.0
+    _interned = True
+
+    @classmethod
+    def _compile(cls):
+        """Compile the similarities between all pairs of months into
+        a matrix indexed by month number."""
+        cls._codes = dict([(m,i) for (i,m) in enumerate(cls._months)])
+        cls._similarities = [[cls._month_similarity(a, b) for b in cls._months]
+                             for a in cls._months]
 
     def _set_value(self, value):
         value_norm = value.capitalize()
         if not value_norm in self._months:
             raise ValueError("Unrecognised value for %s: '%s'." % (self.name, value))
         self._value = value_norm
+        self._update_code()
 
-    def similarity(self, other):
+    def _update_code(self):
+        self._code = self._codes[self._value]
+
+    @classmethod
+    def _month_similarity(cls, value, other):
         """Similarity metric for season. Perfect match if value is
         the same. Otherwise, _fuzz_similarity if it's an adjacent month
         or the same season"""
-        if self.value == other.value:
-            return self.weight
+        if value == other:
+            return cls._weight
 
-        idx_self = self._months.index(self.value)
-        idx_other = self._months.index(other.value)
+        idx_self = cls._months.index(value)
+        idx_other = cls._months.index(other)
         season_self = 0
         season_other = 0
-        for i,season in enumerate(self._seasons):
+        for i,season in enumerate(cls._seasons):
             if idx_self in season:
                 season_self = i
             if idx_other in season:
@@ -206,10 +260,22 @@ class Season(attributes.Attribute):
         # months is not a problem in this case, since that occurs
         # within one season (winter)
         if season_self == season_other or abs(idx_self-idx_other) == 1:
-            return self._fuzz_similarity*self.weight
+            return cls._fuzz_similarity*cls._weight
 
         return 0.0
 
+    def similarity(self, other):
+        """Similarity is looked up in the precomputed matrix."""
+        return self._similarities[self._code][other._code]
+
+    def scorer(self):
+        if type(self).similarity is not Season.similarity:
+            return self.similarity
+        row = self._similarities[self._code]
+        def score(other):
+            return row[other._code]
+        return score
+
 
 class Accommodation(attributes.MoreIsPerfect):
     """Type of accommodation for holiday.
@@ -220,6 +286,8 @@ class Accommodation(attributes.MoreIsPerfect):
     Possible values: Numerical value 0-5, or one of 'Holiday flat',
     (One [star]...Five [stars])."""
 
+    __slots__ = ()
+
     # Dictionaries to turn numbers into words and back. Also
     # specifies the valid values for this attribute.
     _numbers = {0:"Holiday flat",1:"One", 2:"Two", 3:"Three", 4:"Four",5:"Five",}
@@ -234,7 +302,7 @@ class Accommodation(attributes.MoreIsPerfect):
     def _set_value(self, value):
         """Convert a value of type 'TwoStars' into an integer"""
         # Special case for "holiday flat" - seen as 0-star
-        if value.lower() == "holiday flat":
+        if str(value).lower() == "holiday flat":
             self._value = 0
             return
 
@@ -260,4 +328,6 @@ class Hotel(attributes.CaseLessMatch):
 
     Possible values: Any string."""
 
+    __slots__ = ()
+
     _weight = 10.0
@@ -19,6 +19,7 @@
 ## You should have received a copy of the GNU General Public License
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import weakref
 from abc import ABCMeta, abstractmethod, abstractproperty
 
 from tree import Tree
@@ -28,6 +29,9 @@ class BaseAttribute(object, metaclass=ABCMeta):
     """Base class that Attribute inherits from. Specifies the
     interface that Attribute classes must conform to. Attribute
     contains default implementations of all interface methods."""
+
+    __slots__ = ()
+
     @abstractproperty
     def adaptable(self):
         """Whether or not this attribute can be adapted to form a new
@@ -85,6 +89,8 @@ class Attribute(BaseAttribute):
     value, defining equality on these, and providing the similarity
     distance (which by default always matches)."""
 
+    __slots__ = ('_value', '_code', '_matching_set', '__weakref__')
+
     _adaptable = False
     @property
     def adaptable(self):
@@ -146,6 +152,7 @@ class Attribute(BaseAttribute):
     def value(self,value):
         if type(value) == type(self):
             self._value = value._value
+            self._update_code()
         else:
             self._set_value(value)
 
@@ -162,6 +169,68 @@ class Attribute(BaseAttribute):
     def __init__(self, value=None):
         self.value = value
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._instances = weakref.WeakValueDictionary()
+        cls._compile()
+
+    @classmethod
+    def _compile(cls):
+        """Precompute similarity tables for the domain of the
+        attribute. Called when the class is defined - to be overridden
+        in subclasses."""
+        pass
+
+    def _update_code(self):
+        """Set the code of the current value in the precomputed
+        similarity tables - to be overridden in subclasses."""
+        pass
+
+    _interned = False
+
+    @classmethod
+    def create(cls, value):
+        """Create an attribute with the given value.
+
+        If _interned is set, equal values share a single instance. This
+        is safe since attributes are never modified once created (see
+        Case.__setitem__), and saves memory for attributes with few
+        distinct values. Instances are only kept for as long as they
+        are in use (e.g. by the case base), and only under their
+        normalised value (see _intern_key()), so values that are only
+        used in queries are not kept once the queries are gone."""
+        if not cls._interned:
+            return cls(value)
+        attr = cls(value)
+        return cls._instances.setdefault(attr._intern_key(), attr)
+
+    def _intern_key(self):
+        """Key that identifies equal attribute values"""
+        return self._value
+
+    def encode(self):
+        """Plain (JSON serialisable) representation of the value, from
+        which decode() recreates the attribute."""
+        return self._value
+
+    @classmethod
+    def decode(cls, data):
+        return cls.create(data)
+
+    def __getstate__(self):
+        state = {'_value': self._value}
+        if hasattr(self, '_matching_set'):
+            state['_matching_set'] = self._matching_set
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled attribute. Value codes are not pickled,
+        but looked up again from the value."""
+        for key,value in list(state.items()):
+            if key != '_code':
+                setattr(self, key, value)
+        self._update_code()
+
     def similarity(self, other):
         """Similarity metric between 0 and the selected weight. By
         default attributes with the same name are always equal."""
@@ -170,6 +239,14 @@ class Attribute(BaseAttribute):
         else:
             return 0.0
 
+    def scorer(self):
+        """Function computing similarity(other), with everything that
+        only depends on this attribute looked up in advance. Used to
+        compile queries (see Case.compile()), so the result must be
+        identical to that of similarity(). By default, this is just
+        similarity()."""
+        return self.similarity
+
 
     def adapt_distance(self, other):
         """Return the adaptation distance, which is a positive or
@@ -205,24 +282,60 @@ class ExactMatch(Attribute):
     """Exact matching attribute, that provides a full (i.e. weight
     match) on the same value, and zero similarity otherwise."""
 
+    __slots__ = ()
+
     def similarity(self, other):
         if self.name == other.name and self.value == other.value:
             return self.weight
         else:
             return 0.0
 
+    def scorer(self):
+        if type(self).similarity is not ExactMatch.similarity:
+            return self.similarity
+        name, value, weight = self.name, self.value, self.weight
+        def score(other):
+            if name == other.name and value == other.value:
+                return weight
+            return 0.0
+        return score
+
 class CaseLessMatch(Attribute):
-    """Case-insensitive match on attribute value."""
+    """Case-insensitive match on attribute value.
+
+    The lowercased value is kept as the code of the attribute, so
+    comparisons are done on the codes."""
+
+    __slots__ = ()
+
+    def _set_value(self, value):
+        self._value = value
+        self._update_code()
+
+    def _update_code(self):
+        self._code = self._value.lower()
 
     def similarity(self, other):
-        if self.value.lower() == other.value.lower():
+        if self._code == other._code:
             return self.weight
         else:
             return 0.0
 
+    def scorer(self):
+        if type(self).similarity is not CaseLessMatch.similarity:
+            return self.similarity
+        code, weight = self._code, self.weight
+        def score(other):
+            if code == other._code:
+                return weight
+            return 0.0
+        return score
+
 class Numeric(Attribute):
     """Attribute with positive numeric values."""
 
+    __slots__ = ()
+
     def _set_value(self,value):
         if type(value) == type(self):
             self._value = value._value
@@ -241,6 +354,8 @@ class Numeric(Attribute):
 class LinearMatch(Numeric):
     """Matches linearly on a numeric attribute value."""
 
+    __slots__ = ()
+
     _scale = 1.0
 
     def similarity(self, other):
@@ -248,10 +363,38 @@ class LinearMatch(Numeric):
         difference, scaled by self.scale."""
         return self.weight*(1.0-self.scale(abs(self.value-other.value), [self.value, other.value]))
 
+    def scorer(self):
+        if type(self).similarity is not LinearMatch.similarity:
+            return self.similarity
+        return self._linear_scorer()
+
+    def _linear_scorer(self):
+        """Scorer for the linear similarity, doing the same floating
+        point operations as similarity() and scale(). The minimum and
+        maximum of the range and the query value are found in advance;
+        min() and max() do not round, so the order does not matter."""
+        value, weight = self.value, self.weight
+        if hasattr(self, '_range'):
+            low = min([self._range[0], value])
+            high = max([self._range[1], value])
+            def score(other):
+                other = other.value
+                return weight*(1.0-abs(value-other)/(max(high, other)-min(low, other)))
+        elif hasattr(self, '_scale'):
+            scale = self._scale
+            def score(other):
+                return weight*(1.0-abs(value-other.value)/scale)
+        else:
+            def score(other):
+                return weight*(1.0-abs(value-other.value))
+        return score
+
 class NumericAdapt(Numeric):
     """Exact match, but allow numeric adaptation based on this
     attribute."""
 
+    __slots__ = ()
+
     _adaptable = True
     def adapt_distance(self, other):
         """Return the adaptation distance, i.e. the ratio of the other
@@ -264,6 +407,9 @@ class NumericAdapt(Numeric):
 
 class LinearAdjust(Attribute):
     """Linear numeric adjustment of value."""
+
+    __slots__ = ()
+
     _adjustable = True
 
     def adjusted(self, value):
@@ -274,49 +420,144 @@ class LessIsPerfect(LinearMatch):
     the other value is less than this one, in which case it is a
     perfect match."""
 
+    __slots__ = ()
+
     def similarity(self,other):
         if other.value < self.value:
             return self.weight
         return LinearMatch.similarity(self,other)
 
+    def scorer(self):
+        if type(self).similarity is not LessIsPerfect.similarity:
+            return self.similarity
+        value, weight = self.value, self.weight
+        linear = self._linear_scorer()
+        def score(other):
+            if other.value < value:
+                return weight
+            return linear(other)
+        return score
+
 class MoreIsPerfect(LinearMatch):
     """A 'Less is perfect' match, which is a linear match except when
     the other value is less than this one, in which case it is a
     perfect match."""
 
+    __slots__ = ()
+
     def similarity(self,other):
         if other.value > self.value:
             return self.weight
         return LinearMatch.similarity(self,other)
 
+    def scorer(self):
+        if type(self).similarity is not MoreIsPerfect.similarity:
+            return self.similarity
+        value, weight = self.value, self.weight
+        linear = self._linear_scorer()
+        def score(other):
+            if other.value > value:
+                return weight
+            return linear(other)
+        return score
+
 class TableMatch(Attribute):
     """Table matching, by comparing values to a predefined table
     (nested dictionaries) to get a similarity measure."""
 
+    __slots__ = ()
+
     _match_table = {}
+    _interned = True
+
+    @classmethod
+    def _compile(cls):
+        """Compile the match table into a matrix of weighted
+        similarities, indexed by value code."""
+        domain = list(cls._match_table.keys())
+        cls._codes = dict([(v,i) for (i,v) in enumerate(domain)])
+        cls._similarities = [[cls._match_table[a][b] * cls._weight for b in domain]
+                             for a in domain]
 
     def similarity(self, other):
-        return self._match_table[self.value][other.value] * self.weight
+        return self._similarities[self._code][other._code]
+
+    def scorer(self):
+        if type(self).similarity is not TableMatch.similarity:
+            return self.similarity
+        row = self._similarities[self._code]
+        def score(other):
+            return row[other._code]
+        return score
 
     def _set_value(self, value):
         try:
             self._value = key_name(value, self._match_table)
         except KeyError:
             raise ValueError("Unrecognised value for %s: '%s'." % (self.name, value))
+        self._update_code()
+
+    def _update_code(self):
+        self._code = self._codes[self._value]
 
 class TreeMatch(Attribute):
     """Tree matching, by finding the nearest common ancestor between two values."""
 
+    __slots__ = ()
+
     _match_tree = Tree(["root", 0.0, []])
+    _interned = True
+
+    # Maximum number of rows of similarities kept (see _row()).
+    _cached_rows = 256
+
+    @classmethod
+    def _compile(cls):
+        """Number the node names of the tree. The weighted
+        similarities of a value to all node names are only computed
+        when the value is first compared (see _row()), so large trees
+        are not compared pairwise when the class is defined."""
+        cls._domain = cls._match_tree.names()
+        cls._codes = dict([(v,i) for (i,v) in enumerate(cls._domain)])
+        cls._similarities = {}
+
+    @classmethod
+    def _row(cls, code):
+        """Weighted similarities of the value with the given code to
+        all node names, indexed by value code."""
+        row = cls._similarities.get(code)
+        if row is None:
+            value = cls._domain[code]
+            row = [cls._tree_similarity(value, other) for other in cls._domain]
+            if len(cls._similarities) >= cls._cached_rows:
+                cls._similarities.clear()
+            cls._similarities[code] = row
+        return row
+
+    @classmethod
+    def _tree_similarity(cls, value, other):
+        if value == other:
+            return cls._weight
+
+        return cls._match_tree.find_common_value([value, other]) * cls._weight
 
     def similarity(self, other):
-        if self.value == other.value:
-            return self.weight
+        return self._row(self._code)[other._code]
 
-        return self._match_tree.find_common_value([self.value, other.value]) * self.weight
+    def scorer(self):
+        if type(self).similarity is not TreeMatch.similarity:
+            return self.similarity
+        row = self._row(self._code)
+        def score(other):
+            return row[other._code]
+        return score
 
     def _set_value(self, value):
-        if self._match_tree.find_path(value) is None:
+        if not value in self._codes:
             raise ValueError("Unrecognised value for %s: '%s'." % (self.name, value))
         self._value = value
+        self._update_code()
+
+    def _update_code(self):
+        self._code = self._codes[self._value]
 
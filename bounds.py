@@ -0,0 +1,572 @@
+## -*- coding: utf-8 -*-
+##
+## bounds.py
+##
+## Date:     16 October 2026
+## Copyright (c) 2026, the cbr-system contributors
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Branch and bound retrieval.
+
+The similarity of a query to a case is a weighted sum of bounded
+attribute similarities. If the cases are split into partitions, and
+it is known which attribute values occur in each partition, an upper
+bound on the similarity of the query to any case in a partition can
+be computed without looking at the cases. Partitions are then scanned
+best bound first, and the scan stops when the bound of the next
+partition is below the similarity of the worst of the best matches
+found so far. A partition whose bound equals that similarity is also
+skipped if all its cases come after the worst match in the case base,
+since ties are ordered by index."""
+
+__all__ = ['Partition', 'KeyIndex', 'BoundIndex', 'PartitionIndex']
+
+import bisect, heapq
+
+from attributes import ExactMatch, CaseLessMatch, LinearMatch, LessIsPerfect, MoreIsPerfect
+
+# Attributes whose similarity falls with the numeric distance between
+# the values; their bound only needs the lowest and highest value.
+_linear_methods = (LinearMatch.similarity,
+                   LessIsPerfect.similarity,
+                   MoreIsPerfect.similarity)
+
+def _match_key(attr):
+    """Key of an exact match attribute; two attributes get a full
+    match exactly when their keys are equal."""
+    if type(attr).similarity is CaseLessMatch.similarity:
+        return attr._code
+    return attr.value
+
+def _value_key(attr):
+    try:
+        key = attr._intern_key()
+        hash(key)
+        return key
+    except TypeError:
+        return id(attr)
+
+def _excluded(bound, index, worst):
+    """Whether the cases with a (normalised) similarity of at most
+    bound, from case number index on, cannot be among the best
+    matches. worst is the (similarity, index) of the worst of the best
+    matches found so far, or None if there are not enough matches
+    yet. Cases with the same similarity as the worst match are ordered
+    by index, so they are only excluded if they come after it."""
+    if worst is None:
+        return False
+    return bound < worst[0] or (bound == worst[0] and index > worst[1])
+
+class Partition(object):
+    """A group of cases, summarised to bound their similarity.
+
+    The partition attributes attrs have the same value in all cases.
+    For the other attributes, the partition keeps the lowest and
+    highest value of linearly matched attributes, the (counted) keys
+    of exact match attributes, and the (counted) distinct values of
+    all other attributes. Attributes in ignore are not summarised.
+
+    members holds the (sorted) indices of the cases, unless it is set
+    to None; a summary of a larger group then only counts them. first
+    is the lowest index of the cases (or None if there are none);
+    without members, it is not raised when cases are removed, so it
+    can be lower than the lowest index."""
+
+    def __init__(self, attrs={}, ignore=()):
+        self.attrs = attrs
+        self.ignore = ignore
+        self.members = []
+        self.size = 0
+        self.first = None
+        self.counts = {}
+        self.limits = {}
+        self.keys = {}
+        self.values = {}
+
+    def add(self, index, case):
+        if self.members is not None:
+            bisect.insort(self.members, index)
+        if self.first is None or index < self.first:
+            self.first = index
+        self.size += 1
+        for name,attr in list(case.items()):
+            self.add_value(name, attr)
+
+    def add_value(self, name, attr, count=1):
+        """Count count cases with the attribute attr. This is used by
+        add(), and directly when cases are summarised column by column,
+        in which case the caller sets members, first and size."""
+        if name in self.ignore:
+            return
+        self.counts[name] = self.counts.get(name, 0) + count
+        if name in self.attrs:
+            return
+        method = type(attr).similarity
+        if method in _linear_methods:
+            limits = self.limits.get(name)
+            if limits is None:
+                self.limits[name] = [attr, attr]
+            elif attr.value < limits[0].value:
+                limits[0] = attr
+            elif attr.value > limits[1].value:
+                limits[1] = attr
+        elif method is ExactMatch.similarity or method is CaseLessMatch.similarity:
+            keys = self.keys.setdefault(name, {})
+            key = _match_key(attr)
+            keys[key] = keys.get(key, 0) + count
+        else:
+            values = self.values.setdefault(name, {})
+            key = _value_key(attr)
+            if key in values:
+                values[key][0] += count
+            else:
+                values[key] = [count, attr]
+
+    def merge(self, other):
+        """Add the cases summarised by other, which must have the same
+        partition attributes and ignore the same attributes. This
+        gives the same summary as adding the cases one by one."""
+        if self.members is not None:
+            self.members = sorted(self.members + (other.members or []))
+        if self.first is None or (other.first is not None and other.first < self.first):
+            self.first = other.first
+        self.size += other.size
+        for name,count in list(other.counts.items()):
+            self.counts[name] = self.counts.get(name, 0) + count
+        for name,(low,high) in list(other.limits.items()):
+            limits = self.limits.get(name)
+            if limits is None:
+                self.limits[name] = [low, high]
+                continue
+            if low.value < limits[0].value:
+                limits[0] = low
+            if high.value > limits[1].value:
+                limits[1] = high
+        for name,other_keys in list(other.keys.items()):
+            keys = self.keys.setdefault(name, {})
+            for key,count in list(other_keys.items()):
+                keys[key] = keys.get(key, 0) + count
+        for name,other_values in list(other.values.items()):
+            values = self.values.setdefault(name, {})
+            for key,(count,attr) in list(other_values.items()):
+                if key in values:
+                    values[key][0] += count
+                else:
+                    values[key] = [count, attr]
+
+    def remove(self, index, case):
+        """Remove a case. The limits are not narrowed, as they still
+        give a valid (if looser) bound."""
+        if self.members is not None:
+            self.members.remove(index)
+            self.first = min(self.members) if self.members else None
+        self.size -= 1
+        for name,attr in list(case.items()):
+            if name in self.ignore:
+                continue
+            self.counts[name] -= 1
+            if name in self.keys:
+                key = _match_key(attr)
+                self.keys[name][key] -= 1
+                if not self.keys[name][key]:
+                    del self.keys[name][key]
+            elif name in self.values:
+                key = _value_key(attr)
+                self.values[name][key][0] -= 1
+                if not self.values[name][key][0]:
+                    del self.values[name][key]
+
+    def shift(self, index):
+        """Move the members after index down one index."""
+        if self.members is not None:
+            self.members = [i-1 if i > index else i for i in self.members]
+        if self.first is not None and self.first > index:
+            self.first -= 1
+
+    def excluded(self, bound, worst):
+        """Whether none of the cases can be among the best matches,
+        given the (normalised) bound of the partition and worst (see
+        _excluded())."""
+        return _excluded(bound, self.first, worst)
+
+    def bound(self, attrs, cache):
+        """Upper bound of the summed similarity of the query attributes
+        attrs to any case in the partition, summed in the same order
+        as Case.similarity() does, so it is never below the sum of any
+        case. cache holds similarities to distinct values, and is
+        shared between the partitions."""
+        total = 0.0
+        for attr in attrs:
+            name = attr.name
+            count = self.counts.get(name, 0)
+            if not count:
+                continue
+            if name in self.attrs:
+                sim = attr.similarity(self.attrs[name])
+            elif name in self.limits:
+                low,high = self.limits[name]
+                if attr.value < low.value:
+                    sim = attr.similarity(low)
+                elif attr.value > high.value:
+                    sim = attr.similarity(high)
+                else:
+                    sim = attr.weight
+            elif name in self.keys:
+                sim = attr.weight if _match_key(attr) in self.keys[name] else 0.0
+            else:
+                sim = None
+                for key,(c,value) in list(self.values.get(name, {}).items()):
+                    if not (name, key) in cache:
+                        cache[(name, key)] = attr.similarity(value)
+                    if sim is None or cache[(name, key)] > sim:
+                        sim = cache[(name, key)]
+                if sim is None:
+                    continue
+            if count < self.size:
+                # Cases without the attribute add nothing.
+                sim = max(sim, 0.0)
+            total += sim
+        return total
+
+# Similarity methods of the attributes that can be looked up in a
+# KeyIndex: a case gets the full weight of the attribute if it has the
+# same key, and 0 otherwise.
+_key_methods = (ExactMatch.similarity, CaseLessMatch.similarity)
+
+class KeyIndex(object):
+    """Inverted indexes of the exact match attributes names of cases,
+    mapping each of their keys (see _match_key(); case-insensitive for
+    Hotel) to the (sorted) indices of the cases with that key.
+
+    The index of an attribute is built from the cases when it is first
+    looked up, so the values of a case store do not all have to be
+    decoded when it is opened; the index of a case table is built from
+    its columns, so each distinct value is only looked at once. Once
+    built, the indexes are kept up to date by add() and remove(),
+    which must be called after the cases have been changed."""
+
+    def __init__(self, cases=(), names=('JourneyCode', 'Hotel')):
+        self.cases = cases
+        self.names = names
+        self.indexes = {}
+
+    def _keys(self, name):
+        """The index of attribute name, built on first use."""
+        keys = self.indexes.get(name)
+        if keys is not None:
+            return keys
+        keys = self.indexes[name] = {}
+        columns = getattr(self.cases, 'columns', None)
+        if columns is None:
+            for i,case in enumerate(self.cases):
+                if name in case:
+                    keys.setdefault(_match_key(case[name]), []).append(i)
+            return keys
+        column = columns.get(name)
+        if column is None:
+            return keys
+        codes = getattr(column, 'codes', None)
+        if codes is None:
+            # A number column of a case store holds the encoded
+            # values, which are the values of numeric attributes.
+            codes = column.numbers
+            key = int
+        else:
+            key = [_match_key(attr) for attr in column.values].__getitem__
+        members = {}
+        for i,code in enumerate(codes):
+            if code >= 0:
+                members.setdefault(code, []).append(i)
+        for code,indices in list(members.items()):
+            k = key(code)
+            if k in keys:
+                keys[k] = sorted(keys[k] + indices)
+            else:
+                keys[k] = indices
+        return keys
+
+    def add(self, index, case):
+        """Add case number index."""
+        for name,keys in list(self.indexes.items()):
+            if name in case:
+                bisect.insort(keys.setdefault(_match_key(case[name]), []), index)
+
+    def discard(self, index, case):
+        """Remove case number index, without moving the other cases."""
+        for name,keys in list(self.indexes.items()):
+            if name in case:
+                key = _match_key(case[name])
+                keys[key].remove(index)
+                if not keys[key]:
+                    del keys[key]
+
+    def replace(self, index, case, old_case):
+        """Replace case number index (old_case) with case."""
+        self.discard(index, old_case)
+        self.add(index, case)
+
+    def remove(self, index, case):
+        """Remove case number index (case). The cases after it move
+        down one index."""
+        self.discard(index, case)
+        for keys in list(self.indexes.values()):
+            for key,members in list(keys.items()):
+                if members[-1] > index:
+                    keys[key] = [i-1 if i > index else i for i in members]
+
+    def indexed(self, attr):
+        """Whether the cases matching query attribute attr can be
+        looked up in the indexes."""
+        return attr.name in self.names and type(attr).similarity in _key_methods
+
+    def lookup(self, attr):
+        """The (sorted) indices of the cases with the same key as
+        attr."""
+        return self._keys(attr.name).get(_match_key(attr), [])
+
+    def find(self, attr):
+        """Index of the first case with the same key as attr, or -1 if
+        there is none."""
+        members = self.lookup(attr)
+        return members[0] if members else -1
+
+    def match(self, query, count, similarity=None):
+        """Find the count best matches of query (as (similarity, index)
+        tuples, ordered like Matcher.match()) among the cases with the
+        same key as any of its indexed attributes, if they are certain
+        to be the best matches in the whole case base. Returns None
+        otherwise, and if the query has no indexed attributes.
+
+        Every other case gets 0 on the indexed attributes, so its
+        similarity is at most the summed weight of the rest of the
+        query; with no other attributes, it is 0, and the first of
+        these cases fill up the result. similarity is the compiled
+        query, if it is at hand."""
+        if count <= 0:
+            return []
+        candidates = set()
+        total_weight = rest_weight = 0.0
+        indexed = False
+        for attr in list(query.values()):
+            if not attr.matching:
+                continue
+            total_weight += attr.weight
+            if self.indexed(attr):
+                indexed = True
+                candidates.update(self.lookup(attr))
+            else:
+                # Summed in query order, like Case.similarity(), so it
+                # is never below the sum of any case.
+                rest_weight += attr.weight
+        if not indexed or total_weight == 0.0:
+            return None
+        if similarity is None:
+            similarity = query.compile()
+        best = [(similarity(self.cases[i]), i) for i in sorted(candidates)]
+        if rest_weight == 0.0:
+            others = []
+            i = 0
+            while len(others) < count and i < len(self.cases):
+                if not i in candidates:
+                    others.append((0.0, i))
+                i += 1
+            best.extend(others)
+        best.sort(key=lambda x: (-x[0], x[1]))
+        best = best[:count]
+        if rest_weight > 0.0 and (len(best) < count or
+                                  best[-1][0] <= rest_weight / total_weight):
+            # Cases outside the indexes can be as good as the worst of
+            # these.
+            return None
+        return best
+
+class BoundIndex(object):
+    """Base class of the indexes used for retrieval with bounds.
+
+    The exact match attributes JourneyCode and Hotel are kept in
+    inverted indexes (a KeyIndex), mapping each of their
+    (case-insensitive, for Hotel) values to the cases that have it.
+    The cases with the values of the query are compared first, and
+    since every other case has a similarity of 0 on these attributes,
+    they are left out of the bounds. If keys is given, it is the
+    KeyIndex of the cases, which is kept up to date by its owner (see
+    Matcher); otherwise, the index keeps its own.
+
+    Subclasses group the rest of the cases (see _insert()), and find
+    the best matches among them in _search().
+
+    match() returns exactly the same result as scanning all cases:
+    cases are only skipped if their bound is below the similarity of
+    the worst match found, or equal to it while the cases come after
+    the worst match, so cases with equal similarity are still found
+    and ordered by index."""
+
+    index_attributes = ('JourneyCode', 'Hotel')
+
+    def __init__(self, cases, keys=None):
+        self.cases = cases
+        self.size = 0
+        self._own_keys = keys is None
+        if keys is None:
+            keys = KeyIndex(cases, self.index_attributes)
+        self.keys = keys
+
+    def add(self, index, case):
+        """Add case number index, which must be the last case."""
+        self._insert(index, case)
+        if self._own_keys:
+            self.keys.add(index, case)
+        self.size += 1
+
+    def replace(self, index, case, old_case):
+        """Replace case number index (old_case) with case."""
+        self._delete(index, old_case)
+        self._insert(index, case)
+        if self._own_keys:
+            self.keys.replace(index, case, old_case)
+
+    def remove(self, index, case):
+        """Remove case number index (case). The cases after it move
+        down one index."""
+        self._delete(index, case)
+        self._shift(index)
+        if self._own_keys:
+            self.keys.remove(index, case)
+        self.size -= 1
+
+    def _insert(self, index, case):
+        """Add case number index to the groups. index is either a new
+        last case, or a case that was just deleted."""
+        raise NotImplementedError
+
+    def _delete(self, index, case):
+        """Remove case number index from the groups, without moving
+        the other cases."""
+        raise NotImplementedError
+
+    def _shift(self, index):
+        """Move the cases after index down one index in the groups."""
+        raise NotImplementedError
+
+    def match(self, query, count, probes=None):
+        """Return the count best matches as (similarity, index)
+        tuples, ordered the same way as Matcher.match().
+
+        If probes is given, the search stops after comparing that many
+        groups (or as soon as count cases have been compared, if that
+        takes more groups), so the result is only approximate."""
+        if count <= 0:
+            return []
+        attrs = [attr for attr in list(query.values()) if attr.matching]
+        total_weight = 0.0
+        for attr in attrs:
+            total_weight += attr.weight
+        if total_weight == 0.0:
+            return [(0.0, i) for i in range(min(count, self.size))]
+
+        # Min-heap of the best (similarity, -index) tuples found so
+        # far; the root is the worst of them.
+        best = []
+        similarity = query.compile()
+        def compare(i):
+            item = (similarity(self.cases[i]), -i)
+            if len(best) < count:
+                heapq.heappush(best, item)
+            elif item > best[0]:
+                heapq.heapreplace(best, item)
+
+        # Compare the cases found in the indexes first.
+        candidates = set()
+        for attr in attrs:
+            if self.keys.indexed(attr):
+                candidates.update(self.keys.lookup(attr))
+        for i in sorted(candidates):
+            compare(i)
+
+        bound_attrs = [attr for attr in attrs if not self.keys.indexed(attr)]
+        def worst():
+            """(similarity, index) of the worst of the best matches,
+            or None if there are less than count yet."""
+            return (best[0][0], -best[0][1]) if len(best) == count else None
+        for groups,(bound,partition) in enumerate(self._search(bound_attrs, total_weight, worst)):
+            if probes is not None and groups >= probes and len(best) == count:
+                break
+            for i in partition.members:
+                if _excluded(bound, i, worst()):
+                    # So are the rest of the (sorted) members.
+                    break
+                if not i in candidates:
+                    compare(i)
+        return [(sim, -i) for (sim, i) in sorted(best, reverse=True)]
+
+    def _search(self, attrs, total_weight, worst):
+        """Generate the groups of cases that must be compared to the
+        query, as (normalised bound, Partition) tuples. A group can be
+        skipped if it is excluded() by its bound and worst()."""
+        raise NotImplementedError
+
+class PartitionIndex(BoundIndex):
+    """The case base, split into partitions by the values of the
+    partition attributes: the high weight attributes with few distinct
+    values. The partitions are compared best bound first, stopping
+    at the first partition that cannot contain any of the best
+    matches."""
+
+    partition_attributes = ('HolidayType', 'Transportation')
+
+    def __init__(self, cases, keys=None):
+        BoundIndex.__init__(self, cases, keys)
+        self.partitions = {}
+        self.partition_of = []
+        for i,case in enumerate(cases):
+            self.add(i, case)
+
+    def _partition(self, case):
+        key = tuple([case[name].value if name in case else None
+                     for name in self.partition_attributes])
+        if not key in self.partitions:
+            attrs = dict([(name, case[name]) for name in self.partition_attributes if name in case])
+            self.partitions[key] = Partition(attrs, self.index_attributes)
+        return self.partitions[key]
+
+    def _insert(self, index, case):
+        partition = self._partition(case)
+        partition.add(index, case)
+        if index == len(self.partition_of):
+            self.partition_of.append(partition)
+        else:
+            self.partition_of[index] = partition
+
+    def _delete(self, index, case):
+        self.partition_of[index].remove(index, case)
+
+    def _shift(self, index):
+        del self.partition_of[index]
+        for partition in list(self.partitions.values()):
+            partition.shift(index)
+
+    def _search(self, attrs, total_weight, worst):
+        cache = {}
+        bounds = [(partition.bound(attrs, cache) / total_weight, partition)
+                  for partition in list(self.partitions.values()) if partition.size]
+        # Partitions with equal bounds are taken in case base order,
+        # so the first of them fill up the best matches, and the rest
+        # can be excluded.
+        bounds.sort(key=lambda x: (-x[0], x[1].first))
+        for bound,partition in bounds:
+            if worst() is not None and bound < worst()[0]:
+                break
+            if not partition.excluded(bound, worst()):
+                yield bound, partition
@@ -19,7 +19,10 @@
 ## You should have received a copy of the GNU General Public License
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ['Case']
+__all__ = ['Case', 'CaseTable']
+
+from array import array
+from collections.abc import Mapping
 
 from attributes import BaseAttribute
 import attribute_names
@@ -56,7 +59,7 @@ class Case(dict):
         else:
             if not hasattr(attribute_names, name):
                 raise KeyError("Unable to process attribute name: %s" % name)
-            super(Case, self).__setitem__(name,getattr(attribute_names, name)(value))
+            super(Case, self).__setitem__(name,getattr(attribute_names, name).create(value))
 
     def __repr__(self):
         return "<Case: %s>" % (", ".join(map(repr, list(self.values()))))
@@ -81,6 +84,33 @@ class Case(dict):
             return 0.0
         return total_similarity / total_weight
 
+    def compile(self):
+        """Compile this case, as a query, into a function computing the
+        similarity of another case to it. The function gives the same
+        result as similarity(), but everything that only depends on
+        the query (which attributes are matched, the total weight, and
+        the query side of each attribute similarity, see
+        Attribute.scorer()) is worked out once, here."""
+        scorers = []
+        total_weight = 0.0
+        for attr in list(self.values()):
+            if attr.matching:
+                scorers.append((attr.name, attr.scorer()))
+                total_weight += attr.weight
+        scorers = tuple(scorers)
+        if total_weight == 0.0:
+            return lambda other: 0.0
+
+        def similarity(other):
+            total_similarity = 0.0
+            for name,score in scorers:
+                try:
+                    total_similarity += score(other[name])
+                except KeyError:
+                    pass
+            return total_similarity / total_weight
+        return similarity
+
     def adapt(self, other):
         """Adapt this case to fit other case.
 
@@ -110,3 +140,235 @@ class Case(dict):
                 new_case[attr.name] = attr
 
         return new_case
+
+
+class TableColumn(object):
+    """One attribute of a CaseTable. Each distinct attribute value is
+    stored once in values, and codes holds the index into values for
+    each case (-1 if the case does not have the attribute).
+
+    The index from values to their codes is only built when a value
+    has to be looked up (see _value_index()), so columns whose values
+    are decoded on access (see store.CaseStore) can be read without
+    decoding all of them."""
+
+    def __init__(self, size=0):
+        self.values = []
+        self.codes = array('i', [-1])*size
+        self._index = {}
+
+    def _value_index(self):
+        """Codes of the distinct values, by (type, intern key)."""
+        if self._index is None:
+            self._index = {}
+            for code,attr in enumerate(self.values):
+                try:
+                    self._index.setdefault((type(attr), attr._intern_key()), code)
+                except TypeError:
+                    pass
+        return self._index
+
+    def code(self, attr):
+        """Code of attr in the column, adding it if it is a new value."""
+        index = self._value_index()
+        try:
+            key = (type(attr), attr._intern_key())
+            code = index.get(key)
+        except TypeError:
+            key = code = None
+        if code is None:
+            code = len(self.values)
+            self.values.append(attr)
+            if key is not None:
+                index[key] = code
+        return code
+
+    def get(self, index):
+        """Attribute of case number index, or None if it has none."""
+        code = self.codes[index]
+        if code < 0:
+            return None
+        return self.values[code]
+
+    def has(self, index):
+        return self.codes[index] >= 0
+
+    def set(self, index, attr):
+        """Set the attribute of case number index (None to remove
+        it)."""
+        self.codes[index] = self.code(attr) if attr is not None else -1
+
+    def find(self, attr):
+        """Index of the first case with an attribute equal to attr, or
+        -1 if there is none."""
+        try:
+            codes = [self._value_index()[(type(attr), attr._intern_key())]]
+        except (KeyError, TypeError):
+            codes = [c for (c,v) in enumerate(self.values) if v == attr]
+        codes = set(codes)
+        if codes:
+            # The codes may be a memoryview (of a case store), which
+            # has no index() method.
+            for i,code in enumerate(self.codes):
+                if code in codes:
+                    return i
+        return -1
+
+    def remove(self, index):
+        """Remove case number index from the column. Its value is
+        kept in values."""
+        del self.codes[index]
+
+    def copy(self):
+        column = TableColumn()
+        column.__setstate__((list(self.values), array('i', self.codes)))
+        return column
+
+    def slice(self, index):
+        """Column for a slice of the cases. It shares the distinct
+        values with this column."""
+        column = TableColumn()
+        column.values = self.values
+        column._index = self._index
+        column.codes = self.codes[index]
+        return column
+
+    def __getstate__(self):
+        return (self.values, self.codes)
+
+    def __setstate__(self, state):
+        self.values, self.codes = state
+        self._index = None
+
+class CaseTable(object):
+    """Compact storage for a list of cases.
+
+    Cases are stored column-wise: each attribute is a TableColumn, so
+    every distinct attribute value is stored once, and each case only
+    takes up an integer code per attribute. Indexing the table gives
+    TableCase objects, which are created on demand and support the
+    same (read-only) API as Case."""
+
+    def __init__(self, cases=[]):
+        self.columns = {}
+        self.size = 0
+        for case in cases:
+            self.append(case)
+
+    def append(self, case):
+        """Add a case (or any mapping of attribute names to
+        attributes) to the end of the table."""
+        for name in case:
+            if not name in self.columns:
+                self.columns[name] = TableColumn(self.size)
+        for name,column in list(self.columns.items()):
+            if name in case:
+                column.codes.append(column.code(case[name]))
+            else:
+                column.codes.append(-1)
+        self.size += 1
+
+    def extend(self, table):
+        """Add all cases of another CaseTable to the end of the
+        table. This gives the same table as appending the cases one by
+        one."""
+        for name in table.columns:
+            if not name in self.columns:
+                self.columns[name] = TableColumn(self.size)
+        for name,column in list(self.columns.items()):
+            if name in table.columns:
+                other = table.columns[name]
+                codes = [column.code(attr) for attr in other.values]
+                column.codes.extend(array('i', [codes[c] if c >= 0 else -1 for c in other.codes]))
+            else:
+                column.codes.extend(array('i', [-1])*table.size)
+        self.size += table.size
+
+    def copy(self):
+        """A copy of the table, which can be changed without changing
+        this table."""
+        table = CaseTable()
+        table.size = self.size
+        for name,column in list(self.columns.items()):
+            table.columns[name] = column.copy()
+        return table
+
+    def replace(self, index, case):
+        """Replace case number index with case."""
+        index = self._check_index(index)
+        for name in case:
+            if not name in self.columns:
+                self.columns[name] = TableColumn(self.size)
+        for name,column in list(self.columns.items()):
+            column.set(index, case[name] if name in case else None)
+
+    def remove(self, index):
+        """Remove case number index from the table."""
+        index = self._check_index(index)
+        for column in list(self.columns.values()):
+            column.remove(index)
+        self.size -= 1
+
+    def find(self, name, attr):
+        """Index of the first case whose name attribute is equal to
+        attr, or -1 if there is none."""
+        column = self.columns.get(name)
+        if column is None:
+            return -1
+        return column.find(attr)
+
+    def _check_index(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("CaseTable index out of range")
+        return index
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            table = CaseTable()
+            table.size = len(range(*index.indices(self.size)))
+            for name,column in list(self.columns.items()):
+                table.columns[name] = column.slice(index)
+            return table
+        return TableCase(self, self._check_index(index))
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield TableCase(self, i)
+
+    def __repr__(self):
+        return "<CaseTable: %d cases>" % self.size
+
+class TableCase(Mapping):
+    """A case stored in a CaseTable. This is a read-only mapping of
+    attribute names to attributes, with the similarity() and adapt()
+    methods of Case."""
+
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, name):
+        attr = self._table.columns[name].get(self._index)
+        if attr is None:
+            raise KeyError(name)
+        return attr
+
+    def __iter__(self):
+        for name,column in list(self._table.columns.items()):
+            if column.has(self._index):
+                yield name
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    similarity = Case.similarity
+    compile = Case.compile
+    adapt = Case.adapt
+    __repr__ = Case.__repr__
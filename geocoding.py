@@ -0,0 +1,180 @@
+## -*- coding: utf-8 -*-
+##
+## geocoding.py
+##
+## Date:     16 October 2026
+## Copyright (c) 2026, the cbr-system contributors
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Geocoders for looking up place names.
+
+A geocoder turns a place name into a (place name, coordinates) tuple,
+or None if it cannot find the place. Gazetteer looks names up in a
+local file, RemoteGeocoder uses the Google geocoder from the geopy
+library (which is only imported when it is first needed), and
+FallbackGeocoder tries a list of geocoders in turn."""
+
+__all__ = ['Geocoder', 'Gazetteer', 'RemoteGeocoder', 'RateLimitedGeocoder',
+           'FallbackGeocoder', 'correction_table', 'normalise']
+
+import csv, difflib, os, re, threading, time, unicodedata
+
+gazetteer_filename = "gazetteer.csv"
+
+# Table of replacement keys to get the right place results on a google
+# search. Source: Wikipedia :)
+correction_table = {"fano": "fanø",
+                     "czechia": "czech republic",
+                     "erz gebirge": "erzgebirge",
+                     "turkish aegean sea": "aegean sea",
+                     "riviera": "french riviera",
+                     "turkish riviera": "istanbul", # close enough
+                     "costa blanca": "costa blance, spain",
+                     "teneriffe": "tenerife",
+                     "salzberger land": "salzburg",
+                     "costa brava": "costa brava, spain",
+                     "atlantic": "bordeaux", # It's by the Atlantic, in France
+                     "algarve": "algarve, portugal",
+                     }
+
+def normalise(name):
+    """Normalised form of a place name, used for matching: lower case,
+    without accents, and with punctuation and repeated spaces
+    removed."""
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join([c for c in name if not unicodedata.combining(c)])
+    return " ".join(re.split(r"\W+", name.lower(), flags=re.UNICODE)).strip()
+
+class Geocoder(object):
+    """Base geocoder class."""
+
+    def geocode(self, name):
+        """Look up name. Returns a (place name, (latitude, longitude))
+        tuple, or None if the place is not found."""
+        raise NotImplementedError
+
+class Gazetteer(Geocoder):
+    """Geocoder using a local table of places.
+
+    The table is a .csv file with the columns name, place_name,
+    latitude and longitude. Names are matched in their normalised
+    form; the keys of the correction table are added as aliases of
+    the names they are corrected to. If no name matches exactly, the
+    closest name is used if it is close enough (as measured by
+    difflib)."""
+
+    def __init__(self, filename=gazetteer_filename, cutoff=0.9):
+        self.filename = filename
+        self.cutoff = cutoff
+        self.places = {}
+        self.aliases = set()
+        if os.path.exists(filename):
+            with open(filename, "r", newline="", encoding="utf-8") as fp:
+                for row in csv.DictReader(fp):
+                    self.add(row['name'], row['place_name'],
+                             (float(row['latitude']), float(row['longitude'])))
+
+    def add(self, name, place_name, coords):
+        """Add a place to the gazetteer (in memory only)."""
+        key = normalise(name)
+        self.places[key] = (place_name, coords)
+        self.aliases.discard(key)
+        for alias,target in list(correction_table.items()):
+            alias = normalise(alias)
+            if normalise(target) == key and (alias in self.aliases or not alias in self.places):
+                self.places[alias] = self.places[key]
+                self.aliases.add(alias)
+        self._names = None
+
+    def geocode(self, name):
+        key = normalise(name)
+        if key in self.places:
+            return self.places[key]
+        if self._names is None:
+            self._names = sorted(self.places.keys())
+        matches = difflib.get_close_matches(key, self._names, 1, self.cutoff)
+        if matches:
+            return self.places[matches[0]]
+        return None
+
+    def save(self, filename=None):
+        with open(filename or self.filename, "w", newline="", encoding="utf-8") as fp:
+            writer = csv.writer(fp)
+            writer.writerow(['name', 'place_name', 'latitude', 'longitude'])
+            for name,(place_name,coords) in sorted(self.places.items()):
+                if name in self.aliases:
+                    continue
+                writer.writerow([name, place_name, repr(coords[0]), repr(coords[1])])
+
+class RemoteGeocoder(Geocoder):
+    """Geocoder using the Google geocoder of the geopy library. The
+    library is imported, and the geocoder created, on the first
+    lookup."""
+
+    def __init__(self, domain="maps.google.co.uk"):
+        self.domain = domain
+        self._geocoder = None
+
+    def _load(self):
+        if self._geocoder is None:
+            try:
+                from geopy import geocoders
+            except ImportError:
+                raise RuntimeError("Could not find geopy library. See http://code.google.com/p/geopy/.")
+            try:
+                self._geocoder = geocoders.Google(domain=self.domain)
+            except AttributeError:
+                self._geocoder = geocoders.GoogleV3(domain=self.domain)
+        return self._geocoder
+
+    def geocode(self, name):
+        result = self._load().geocode(name, exactly_one = False)
+        if not result:
+            return None
+        place_name, coords = list(result)[0]
+        return (place_name, tuple(coords))
+
+class RateLimitedGeocoder(Geocoder):
+    """Wraps another geocoder, starting at most rate lookups per
+    second. The limit is shared by all threads using the geocoder."""
+
+    def __init__(self, geocoder, rate):
+        self.geocoder = geocoder
+        self.interval = 1.0/rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def geocode(self, name):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start-now)
+        return self.geocoder.geocode(name)
+
+class FallbackGeocoder(Geocoder):
+    """Tries each of a list of geocoders in turn, returning the first
+    result found."""
+
+    def __init__(self, geocoders):
+        self.geocoders = list(geocoders)
+
+    def geocode(self, name):
+        for geocoder in self.geocoders:
+            result = geocoder.geocode(name)
+            if result is not None:
+                return result
+        return None
@@ -27,7 +27,7 @@ from console import Console
 from case import Case
 from table_printer import print_table
 from util import key_name
-from matcher import AdaptationError
+from parser import load_queries
 import attribute_names
 
 # Possible attribute names are all classes defined in the attribute_names module
@@ -36,9 +36,20 @@ possible_attributes = dict(inspect.getmembers(attribute_names, inspect.isclass))
 class Interface(Console):
     _default_config = {"retrieve": 2,
                        "adapt": True,
+                       "adaptation": "best",
+                       "ranking": "similarity",
                        "auto_run": True,
                        "auto_display": True,
-                       "verbose_results": False}
+                       "verbose_results": False,
+                       "engine": "numpy",
+                       "retrieval": "scan",
+                       "probes": 4,
+                       "cache_size": 128,
+                       "workers": 0}
+
+    # Config keys that are passed on to the matcher when set.
+    _matcher_config = ("engine", "retrieval", "probes", "workers", "cache_size", "adaptation",
+                       "ranking")
 
     def __init__(self, matcher):
         Console.__init__(self)
@@ -46,6 +57,8 @@ class Interface(Console):
         self.prompt = ">> "
         self.intro = "Welcome to the CBR system. Type 'help' for a list of commands."
         self.matcher = matcher
+        for key in self._matcher_config:
+            self.config[key] = getattr(self.matcher, key)
         if not self.matcher.cases:
             self.intro += "\nNOTE: Currently no cases loaded (you may want to run parser.py to generate some)!"
 
@@ -68,7 +81,7 @@ class Interface(Console):
         return re.sub("\n *", "\n", helpstring)
 
     def do_help(self, arg):
-        if arg in ('status', 'query', 'result', 'config', 'exit'):
+        if arg in ('status', 'query', 'result', 'case', 'config', 'exit'):
             Console.do_help(self, arg)
         else:
             print("\n".join(['These are the accepted commands.',
@@ -77,6 +90,7 @@ class Interface(Console):
                              'status    Show summary of system status.',
                              'query     Manipulate and run query.',
                              'result    Show result of a query.',
+                             'case      Add or remove cases.',
                              'config    Set config variables.',
                              'exit      Exit application.']))
 
@@ -94,6 +108,9 @@ class Interface(Console):
             print("Result exists.")
         else:
             print("No result exists.")
+        cache = self.matcher.cache
+        print("Result cache: %d of %d results cached, %d hits, %d misses." % (len(cache), cache.size,
+                                                                            cache.hits, cache.misses))
 
     def help_status(self):
         print(self.gen_help("do_status"))
@@ -107,11 +124,19 @@ class Interface(Console):
         query unset <attribute>        Unset query attribute <attribute>.
         query names [attribute]        Show possible attribute names.
         query run                      Run the current query.
+        query file <filename>          Run all queries in a .cases or .csv file.
 
         By default, the query is automatically run when changed, and
         the result is automatically displayed when run. This behaviour
         can be changed by setting respectively the 'auto_run' and
-        'auto_display' config parameters."""
+        'auto_display' config parameters.
+
+        The queries in a query file are written in the same format as
+        the case base files read by parser.py, and are matched against
+        the case base in one batch. A line with the best match of each
+        query is printed, rather than the full results. The current
+        query is not changed, and the result of the last query is kept
+        as the result (see 'result')."""
         if arg in ('', 'show'):
             if self.query:
                 print_table([self.query], ["Attribute", "Value"])
@@ -183,23 +208,61 @@ class Interface(Console):
             if not self.query:
                 print("No query to run.")
                 return
-            result = self.matcher.match(self.query, self.config['retrieve'])
-            if result:
-                if self.config['adapt']:
-                    try:
-                        result.insert(0, self.matcher.adapt(self.query, result))
-                    except AdaptationError:
-                        pass
-                self.result = (Case(self.query), result)
-                if self.config['auto_display']:
-                    self.do_result("")
-                elif self.interactive:
-                    print("Query run successfully. Use the 'result' command to view the result.")
-            else:
-                print("no result.")
+            result = self.matcher.retrieve(self.query, self.config['retrieve'], self.config['adapt'])
+            self.set_result(self.query, result)
+        elif arg.startswith('file'):
+            parts = arg.split(None, 1)
+            if len(parts) < 2:
+                print("Usage: query file <filename>.")
+                return
+            self.run_file(parts[1].strip())
         else:
             print("Unrecognised argument. Type 'help query' for help.")
 
+    def set_result(self, query, result):
+        """Store the (adapted, if configured) result of a query, and
+        display it if auto_display is set."""
+        if result:
+            self.result = (Case(query), result)
+            if self.config['auto_display']:
+                self.do_result("")
+            elif self.interactive:
+                print("Query run successfully. Use the 'result' command to view the result.")
+        else:
+            print("no result.")
+
+    def run_file(self, filename):
+        """Run all queries in a .cases or .csv file as one batch."""
+        try:
+            queries = load_queries(filename)
+        except IOError as e:
+            print("Unable to read query file: %s" % e)
+            return
+        results = self.matcher.match_many(queries, self.config['retrieve'])
+        key = self.matcher.key
+        for i,(query,result) in enumerate(zip(queries, results)):
+            if self.config['adapt']:
+                result = self.matcher.adapted(query, result)
+            print(self.summary(i+1, query, result, key))
+        if queries and result:
+            self.result = (Case(query), result)
+        print("Ran %d queries from %s." % (len(queries), filename))
+
+    def summary(self, number, query, result, key):
+        """One line summary of the result of a query in a query file:
+        the best match, and whether it could be adapted."""
+        matches = [(sim,res) for (sim,res) in result if sim != 'adapted']
+        if not matches:
+            return "Query %d: no result." % number
+        sim,best = matches[0]
+        line = "Query %d: best match %s %s (sim. %.3f)" % (number, key,
+                                                          best[key].value if key in best else "-",
+                                                          sim)
+        if len(matches) < len(result):
+            adapted = [res for (s,res) in result if s == 'adapted'][0]
+            line += ", adapted (sim. %.3f)" % query.similarity(adapted)
+        return line + "."
+
     def help_query(self):
         print(self.gen_help("do_query"))
 
@@ -209,7 +272,8 @@ class Interface(Console):
                                                    'unset': list(self.query.keys()),
                                                    'show': [],
                                                    'reset': [],
-                                                   'run': []})
+                                                   'run': [],
+                                                   'file': []})
 
     def do_result(self, args):
         """Print the current query result.
@@ -268,6 +332,61 @@ class Interface(Console):
     def help_result(self):
         print(self.gen_help("do_result"))
 
+    def do_case(self, arg):
+        """Add cases to or remove cases from the case base.
+
+        case add                   Add the current query as a case.
+        case add adapted           Add the adapted result of the last query as a case.
+        case remove <JourneyCode>  Remove the case with the given JourneyCode.
+
+        Added cases are given the next free JourneyCode, unless the
+        query has one. Changes last until the application exits; use
+        parser.py --append to add cases to the case store
+        permanently."""
+        parts = arg.split()
+        key = self.matcher.key
+        if parts and parts[0] == 'add':
+            if len(parts) > 1 and parts[1] == 'adapted':
+                adapted = [res for (sim,res) in self.result[1] if sim == 'adapted'] if self.result else []
+                if not adapted:
+                    print("No adapted result.")
+                    return
+                # The adapted case is a new case, so it should not keep
+                # the JourneyCode of the case it was adapted from.
+                case = Case(adapted[0])
+                if key in case:
+                    del case[key]
+            elif self.query:
+                case = self.query
+            else:
+                print("No current query.")
+                return
+            try:
+                case = self.matcher.add_case(case)
+                print("Added case with %s %s." % (key, case[key].value))
+            except ValueError as e:
+                print(str(e))
+        elif parts and parts[0] == 'remove':
+            if len(parts) < 2:
+                print("Usage: case remove <%s>." % key)
+                return
+            try:
+                self.matcher.remove_case(parts[1])
+                print("Removed case with %s %s." % (key, parts[1]))
+            except KeyError:
+                print("No case with %s %s." % (key, parts[1]))
+            except ValueError as e:
+                print(str(e))
+        else:
+            print("Unrecognised argument. Type 'help case' for help.")
+
+    def help_case(self):
+        print(self.gen_help("do_case"))
+
+    def complete_case(self, text, line, begidx, endidx):
+        return self.completions(text, line, {'add': ['adapted'],
+                                             'remove': []})
+
     def do_config(self, args):
         """View or set configuration variables.
 
@@ -276,10 +395,22 @@ class Interface(Console):
 
         Configuration keys:
         adapt:                     Whether or not to adapt the best case if not a perfect match.
+        adaptation:                Adapt only the 'best' match, or 'all' retrieved matches and
+                                   use the best adapted case.
         auto_display:              Automatically display results after running query.
         auto_run:                  Automatically run query when it changes.
+        cache_size:                Number of query results to keep in the result cache.
+        engine:                    Similarity engine; 'numpy' (vectorised) or 'python'.
+        probes:                    Number of clusters of cases compared with approximate retrieval.
+        ranking:                   Rank matches by their 'similarity' to the query, or by their
+                                   similarity once 'adapted' to it.
+        retrieval:                 Retrieval mode; 'scan' (compare all cases), 'bound' (skip
+                                   partitions of the case base that cannot match), 'tree'
+                                   (skip parts of a KD-tree of the case base that cannot match)
+                                   or 'approximate' (only compare the <probes> nearest clusters).
         retrieve:                  How many cases to retrieve when running queries.
-        verbose_results:           Show similarities (normalised/weighed) for each attribute."""
+        verbose_results:           Show similarities (normalised/weighed) for each attribute.
+        workers:                   Number of worker processes to split the case base between (0 to disable)."""
         if args in ('', 'show'):
             print("Current config:")
             print_table([self.config], ['Key', 'Value'])
@@ -291,6 +422,7 @@ class Interface(Console):
             key,value = parts[1:3]
             if not key in self.config:
                 print("Unrecognised config key: '%s'" % key)
+                return
             try:
                 if type(self.config[key]) in (int, float):
                     self.config[key] = type(self.config[key])(value)
@@ -301,8 +433,17 @@ class Interface(Console):
                         self.config[key] = False
                     else:
                         raise ValueError
+                elif type(self.config[key]) == str:
+                    self.config[key] = value.strip()
             except ValueError:
                 print("Invalid type for key %s: '%s'" % (key,value))
+                return
+            if key in self._matcher_config:
+                try:
+                    setattr(self.matcher, key, self.config[key])
+                except ValueError as e:
+                    print(str(e))
+                self.config[key] = getattr(self.matcher, key)
         else:
             print("Unrecognised argument.")
             self.help_config()
@@ -324,7 +465,7 @@ class Interface(Console):
         return [i+" " for i in current if i.lower().startswith(text.lower())]
 
     def completenames(self, text, line, begidx, endidx):
-        completions = ['help', 'query', 'status', 'result', 'config', 'exit']
+        completions = ['help', 'query', 'status', 'result', 'case', 'config', 'exit']
         if text==line:
             return [i+" " for i in completions if i.startswith(text)]
         return Console.completenames(self, text, line, begidx, endidx)
@@ -0,0 +1,309 @@
+## -*- coding: utf-8 -*-
+##
+## kdtree.py
+##
+## Date:     16 October 2026
+## Copyright (c) 2026, the cbr-system contributors
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""KD-tree over the numeric attributes of the case base.
+
+Every case is a point in a space with an axis for each linearly
+matched attribute (Price, Duration, NumberOfPersons, Accommodation)
+and for the latitude and longitude of the Region. Each axis is scaled
+by the weight of the attribute divided by its range (or scale), so
+distances along the axes are comparable to similarity differences.
+
+The tree splits the space at the median of the widest axis, and each
+node keeps a summary (a bounds.Partition) of all cases below it. The
+tree is searched best bound first, using the same bounds as the
+partition index, so the result is exact.
+
+When the tree is built, only the leaves summarise their cases; the
+summary of an inner node is merged from those of its children. The
+leaves and the points of a case table are summarised column by column,
+so each distinct value is only decoded once. Cases that are added,
+removed or replaced later only change the summaries on the path from
+their leaf to the root, and a leaf that grows too large is replaced by
+a subtree."""
+
+__all__ = ['CaseTree']
+
+import heapq
+from collections import Counter
+from operator import itemgetter
+
+from bounds import Partition, BoundIndex, _linear_methods
+
+def _scale(weight, width):
+    """Scale of an axis of the given weight and width."""
+    if width > 0:
+        return weight/width
+    return weight
+
+def _decoder(column):
+    """The codes of a case table column, and a function decoding a
+    code into its attribute. The number columns of a case store hold
+    the encoded values themselves, so each is only decoded once."""
+    codes = getattr(column, 'codes', None)
+    if codes is not None:
+        return codes, column.values.__getitem__
+    decoded = {}
+    def value(number):
+        if not number in decoded:
+            decoded[number] = column.attribute.decode(number)
+        return decoded[number]
+    return column.numbers, value
+
+def _summariser(cases):
+    """Function adding the cases with the given (ascending) indices to
+    a node. For a case table, each column is summarised by counting
+    its codes, so each distinct value is only added once."""
+    columns = getattr(cases, 'columns', None)
+    if columns is None:
+        def summarise(node, indices):
+            for i in indices:
+                node.add(i, cases[i])
+        return summarise
+    decoders = [(name,) + _decoder(column) for (name, column) in list(columns.items())]
+    def summarise(node, indices):
+        if not indices:
+            return
+        node.members = list(indices)
+        node.first = indices[0]
+        node.size = len(indices)
+        for name,codes,value in decoders:
+            for code,count in list(Counter([codes[i] for i in indices]).items()):
+                if code >= 0:
+                    node.add_value(name, value(code), count)
+    return summarise
+
+class Node(Partition):
+    """A node of the tree. Leaves have the indices of their cases in
+    members, while inner nodes split their cases between two children
+    on the value split of axis number axis."""
+
+    def __init__(self, parent, ignore):
+        Partition.__init__(self, {}, ignore)
+        self.parent = parent
+        self.axis = None
+        self.split = None
+        self.children = None
+
+class CaseTree(BoundIndex):
+    """The case base, stored in a KD-tree."""
+
+    # Leaves are split when they have more than twice this number of
+    # cases.
+    leaf_size = 32
+
+    # Attributes with a place value, whose latitude and longitude are
+    # used as axes.
+    region_attributes = ('Region',)
+
+    def __init__(self, cases, keys=None):
+        BoundIndex.__init__(self, cases, keys)
+        self.axes = self.case_axes(cases)
+        self.coordinates = self._coordinates(cases)
+        self.leaf_of = [None]*len(cases)
+        self.root = self._build(list(range(len(cases))), None, _summariser(cases))
+        self.size = len(cases)
+
+    @classmethod
+    def case_axes(cls, cases):
+        """The axes of the space of cases, as (attribute name,
+        coordinate number, scale) tuples. The coordinate number is None
+        for numeric attributes."""
+        classes = {}
+        columns = getattr(cases, 'columns', None)
+        if columns is not None:
+            for name,column in list(columns.items()):
+                if getattr(column, 'attribute', None) is not None:
+                    classes[name] = column.attribute
+                elif len(column.values):
+                    classes[name] = type(column.values[0])
+        else:
+            for case in cases:
+                for name,attr in list(case.items()):
+                    if not name in classes:
+                        classes[name] = type(attr)
+        axes = []
+        for name,attribute in sorted(classes.items()):
+            if name in cls.region_attributes:
+                # The latitude part of the similarity has 90% of the
+                # weight, the direct distance 10%; one degree of
+                # longitude is taken to be about 111 km.
+                weight,limits = attribute._weight,attribute._range
+                axes.append((name, 0, _scale(weight*0.9, limits[1]-limits[0])))
+                axes.append((name, 1, _scale(weight*0.1*111.0, limits[2])))
+            elif attribute.similarity in _linear_methods:
+                if hasattr(attribute, '_range'):
+                    scale = _scale(attribute._weight, attribute._range[1]-attribute._range[0])
+                elif hasattr(attribute, '_scale'):
+                    scale = _scale(attribute._weight, attribute._scale)
+                else:
+                    scale = attribute._weight
+                axes.append((name, None, scale))
+        return axes
+
+    @staticmethod
+    def coordinate(attr, coordinate, scale):
+        """Position of attr on an axis (see case_axes())."""
+        value = attr.value
+        if coordinate is not None:
+            value = value.coords[coordinate] if value.coords is not None else 0.0
+        return float(value)*scale
+
+    def _point(self, case):
+        """Coordinates of case. Missing values are placed at 0; this
+        only affects how the cases are split, not the bounds."""
+        return [self.coordinate(case[name], coordinate, scale) if name in case else 0.0
+                for name,coordinate,scale in self.axes]
+
+    def _coordinates(self, cases):
+        """Coordinates of all cases, as a list for each axis. Those of
+        a case table are computed once for each distinct value of each
+        column."""
+        columns = getattr(cases, 'columns', None)
+        if columns is None:
+            coordinates = [[] for axis in self.axes]
+            for case in cases:
+                for axis,value in zip(coordinates, self._point(case)):
+                    axis.append(value)
+            return coordinates
+        coordinates = []
+        for name,coordinate,scale in self.axes:
+            column = columns.get(name)
+            if column is None:
+                coordinates.append([0.0]*len(cases))
+                continue
+            codes,value = _decoder(column)
+            by_code = {}
+            for code in set(codes):
+                if code >= 0:
+                    by_code[code] = self.coordinate(value(code), coordinate, scale)
+            coordinates.append([by_code[code] if code >= 0 else 0.0 for code in codes])
+        return coordinates
+
+    def _split(self, indices):
+        """The (axis, value) to split the cases with the given indices
+        on, or None if they cannot be split."""
+        if len(indices) <= self.leaf_size:
+            return None
+        best = None
+        values_of = itemgetter(*indices)
+        for axis in range(len(self.axes)):
+            values = list(values_of(self.coordinates[axis]))
+            spread = max(values) - min(values)
+            if spread > 0 and (best is None or spread > best[0]):
+                best = (spread, axis, values)
+        if best is None:
+            return None
+        spread,axis,values = best
+        values.sort()
+        value = values[len(values)//2]
+        if value == values[0]:
+            # Make sure that both sides get some of the cases.
+            value = min([v for v in values if v > value])
+        return (axis, value)
+
+    def _build(self, indices, parent, summarise):
+        """Build the (sub)tree of the cases with the given (ascending)
+        indices. Only the leaves are summarised, by calling
+        summarise(node, indices); inner nodes merge the summaries of
+        their children."""
+        node = Node(parent, self.index_attributes)
+        split = self._split(indices)
+        if split is None:
+            summarise(node, indices)
+            for i in indices:
+                self.leaf_of[i] = node
+            return node
+        node.members = None
+        node.axis,node.split = split
+        coordinates = self.coordinates[node.axis]
+        left = []
+        right = []
+        for i in indices:
+            (left if coordinates[i] < node.split else right).append(i)
+        node.children = (self._build(left, node, summarise), self._build(right, node, summarise))
+        for child in node.children:
+            node.merge(child)
+        return node
+
+    def _insert(self, index, case):
+        point = self._point(case)
+        if index == len(self.leaf_of):
+            for coordinates,value in zip(self.coordinates, point):
+                coordinates.append(value)
+            self.leaf_of.append(None)
+        else:
+            for coordinates,value in zip(self.coordinates, point):
+                coordinates[index] = value
+        node = self.root
+        while node.children is not None:
+            node.add(index, case)
+            node = node.children[0 if point[node.axis] < node.split else 1]
+        node.add(index, case)
+        self.leaf_of[index] = node
+        if node.size > 2*self.leaf_size and self._split(node.members) is not None:
+            self._rebuild(node)
+
+    def _rebuild(self, leaf):
+        """Replace a leaf that has grown too large by a subtree."""
+        node = self._build(leaf.members, leaf.parent, _summariser(self.cases))
+        if leaf.parent is None:
+            self.root = node
+        else:
+            leaf.parent.children = tuple([node if c is leaf else c for c in leaf.parent.children])
+
+    def _delete(self, index, case):
+        node = self.leaf_of[index]
+        while node is not None:
+            node.remove(index, case)
+            node = node.parent
+
+    def _shift(self, index):
+        for coordinates in self.coordinates:
+            del coordinates[index]
+        del self.leaf_of[index]
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            node.shift(index)
+            if node.children is not None:
+                nodes.extend(node.children)
+
+    def _search(self, attrs, total_weight, worst):
+        cache = {}
+        # Nodes to visit, best bound first and then in case base
+        # order (see PartitionIndex._search()); the counter keeps
+        # nodes from being compared.
+        nodes = [(-self.root.bound(attrs, cache)/total_weight, self.root.first, 0, self.root)]
+        counter = 1
+        while nodes:
+            bound,first,c,node = heapq.heappop(nodes)
+            if worst() is not None and -bound < worst()[0]:
+                break
+            if node.excluded(-bound, worst()):
+                continue
+            if node.children is None:
+                yield -bound, node
+                continue
+            for child in node.children:
+                if child.size:
+                    heapq.heappush(nodes, (-child.bound(attrs, cache)/total_weight, child.first,
+                                           counter, child))
+                    counter += 1
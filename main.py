@@ -22,11 +22,6 @@
 
 import os, sys
 
-try:
-    import pickle as pickle
-except ImportError:
-    import pickle
-
 try:
     import readline, atexit
     history_filename = "cbr_command_history"
@@ -42,23 +37,24 @@ except ImportError:
     pass
 
 
+store_filename = "cases.store"
 case_filename = "cases.pickle"
 
 def main():
     from matcher import Matcher
     from interface import Interface
-    import attribute_names
+    from store import load_cases
+    from ranges import set_ranges
 
-    if os.path.exists(case_filename):
-        with open(case_filename, "rb") as fp:
-            ranges,cases = pickle.load(fp)
-            for k,v in list(ranges.items()):
-                atrcls = getattr(attribute_names, k)
-                atrcls._range = v
+    loaded = load_cases(store_filename, case_filename)
+    if loaded is not None:
+        cases,ranges = loaded
     else:
-        print("Warning: No cases found (looking in '%s')." % case_filename)
+        print("Warning: No cases found (looking in '%s' and '%s')." % (store_filename, case_filename))
+        ranges = {}
         cases = []
-    matcher = Matcher(cases)
+    set_ranges(ranges)
+    matcher = Matcher(cases, ranges=ranges)
     interface = Interface(matcher)
     interface.cmdloop()
 
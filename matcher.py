@@ -19,31 +19,621 @@
 ## You should have received a copy of the GNU General Public License
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import heapq
+from collections import OrderedDict
+from operator import itemgetter
+
+import attribute_names
+import place
+from attributes import BaseAttribute
+from bounds import KeyIndex, PartitionIndex
+from kdtree import CaseTree
+from case import Case, CaseTable
+from shards import ShardPool
+from store import NumberColumn
+from ranges import set_ranges, RangeStatistics
+
+try:
+    from vector import CaseColumns, ClusterIndex, best_indices
+except ImportError:
+    CaseColumns = ClusterIndex = None
+
 class AdaptationError(RuntimeError):
     pass
 
+def query_key(query):
+    """Hashable key of a query, or None if it has unhashable values.
+    The attributes are kept in query order, since it is the order in
+    which their similarities are summed. The attribute ranges are
+    part of the key, since the similarities depend on them, and they
+    can be changed (see ranges.set_ranges()) without this matcher
+    knowing."""
+    key = []
+    for name,attr in list(query.items()):
+        try:
+            value = attr._intern_key()
+            hash(value)
+        except TypeError:
+            return None
+        key.append((name, type(attr), value, attr.weight, attr.matching,
+                    tuple(getattr(attr, '_range', ()))))
+    return tuple(key)
+
+class ResultCache(object):
+    """Cache of query results, keeping the size most recently used
+    ones. Counts the lookups that are found (hits) and not found
+    (misses)."""
+
+    def __init__(self, size):
+        self.entries = OrderedDict()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @size.setter
+    def size(self, size):
+        if size < 0:
+            raise ValueError("Cache size cannot be negative.")
+        self._size = size
+        while len(self.entries) > size:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        """The cached result for key, or None."""
+        if key is None or not key in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, result):
+        if key is None or not self.size:
+            return
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
 class Matcher(object):
-    def __init__(self, cases=[]):
+    """Matches queries against the case base.
+
+    The engine decides how similarities are computed: 'python' calls
+    Case.similarity for each case, while 'numpy' (the default if numpy
+    is available) encodes the case base as columns and computes all
+    similarities with array operations. Both give identical results.
+
+    The retrieval mode decides which cases are compared: 'scan'
+    compares the query to every case, while 'bound' splits the case
+    base into partitions and skips the partitions that cannot contain
+    any of the best matches (see bounds.PartitionIndex), and 'tree'
+    does the same with the leaves of a KD-tree over the numeric
+    attributes (see kdtree.CaseTree). Cases are then compared one at a
+    time, as with the python engine. All give identical results.
+
+    In every retrieval mode, the cases with the JourneyCode or Hotel
+    of the query are looked up in inverted indexes (see
+    bounds.KeyIndex; each is built on its first lookup). If these
+    cases are certain to be the best matches, the rest of the case
+    base is not compared to the query at all.
+
+    For large case bases, retrieval can be made 'approximate': the
+    case base is split into clusters (see vector.ClusterIndex), and
+    only the cases of the probes clusters nearest to the query are
+    compared to it, with array operations, so some of the best
+    matches may be missed (see recall.py for measuring how many).
+    Without numpy, the probes most promising leaves of the KD-tree
+    are compared instead.
+
+    The ranking decides what the matches are ranked by: their
+    'similarity' to the query, or their similarity after being
+    'adapted' to the query (see Case.adapt()), so a case that only
+    differs in adaptable attributes counts as a good match. With
+    adapted ranking, every case is compared to the query, since the
+    retrieval indexes only bound the similarity of the cases
+    themselves.
+
+    If workers is set, the case base is split into that many shards,
+    each matched by a separate worker process.
+
+    The results of retrieve() are kept in a cache of cache_size
+    results, which is cleared when the case base or the way of
+    retrieval changes. The attribute ranges are part of the cache key
+    (see query_key()), so results are not reused once the ranges
+    change.
+
+    Cases can be added, removed and replaced while the matcher is
+    running (see add_case()); the matcher then changes its own copy
+    of the cases, not the case base it was given. ranges are the
+    attribute ranges of the case base (as set with
+    ranges.set_ranges()); if given, they are kept up to date as cases
+    change."""
+
+    engines = ("python", "numpy")
+
+    retrievals = ("scan", "bound", "tree", "approximate")
+
+    adaptations = ("best", "all")
+
+    rankings = ("similarity", "adapted")
+
+    # Index used for each retrieval mode other than 'scan'. Without
+    # numpy, approximate retrieval searches the KD-tree instead.
+    retrieval_indexes = {"bound": PartitionIndex,
+                         "tree": CaseTree,
+                         "approximate": ClusterIndex if ClusterIndex is not None else CaseTree}
+
+    # Partial (top-k) selection is used instead of sorting the whole
+    # case base when fewer than 1/partial_factor of the cases are
+    # requested.
+    partial_factor = 8
+
+    # Attribute identifying cases when adding, removing and replacing
+    # them.
+    key = "JourneyCode"
+
+    def __init__(self, cases=(), engine=None, workers=0, ranges=None, retrieval="scan", probes=4,
+                 cache_size=128, adaptation="best", ranking="similarity"):
+        self._pool = None
+        self.cache = ResultCache(cache_size)
+        self.cases = cases
+        self.ranges = ranges
+        if engine is None:
+            engine = "numpy" if CaseColumns is not None else "python"
+        self.engine = engine
+        self.workers = workers
+        self.retrieval = retrieval
+        self.probes = probes
+        self.adaptation = adaptation
+        self.ranking = ranking
+
+    @property
+    def cases(self):
+        return self._cases
+
+    @cases.setter
+    def cases(self, cases):
+        self.close()
+        self.cache.clear()
+        self._cases = cases
+        self._copied = False
+        self._columns = None
+        self._index = None
+        self._statistics = None
+        self._keys = KeyIndex(cases)
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        if not engine in self.engines:
+            raise ValueError("Unknown engine: '%s'." % engine)
+        if engine == "numpy" and CaseColumns is None:
+            raise ValueError("The numpy engine requires the numpy library.")
+        self.close()
+        self._engine = engine
+
+    @property
+    def retrieval(self):
+        return self._retrieval
+
+    @retrieval.setter
+    def retrieval(self, retrieval):
+        if not retrieval in self.retrievals:
+            raise ValueError("Unknown retrieval mode: '%s'." % retrieval)
+        self.close()
+        self.cache.clear()
+        index = self.retrieval_indexes.get(getattr(self, '_retrieval', None))
+        if self.retrieval_indexes.get(retrieval) is not index:
+            self._index = None
+        self._retrieval = retrieval
+
+    @property
+    def probes(self):
+        """Number of clusters (or KD-tree leaves, without numpy)
+        compared with approximate retrieval. More probes give better
+        results, but take longer."""
+        return self._probes
+
+    @probes.setter
+    def probes(self, probes):
+        if probes < 1:
+            raise ValueError("Number of probes must be positive.")
+        self.close()
+        self.cache.clear()
+        self._probes = probes
+
+    @property
+    def adaptation(self):
+        """Which matches adapt() adapts: the 'best' one, or 'all' of
+        them."""
+        return self._adaptation
+
+    @adaptation.setter
+    def adaptation(self, adaptation):
+        if not adaptation in self.adaptations:
+            raise ValueError("Unknown adaptation mode: '%s'." % adaptation)
+        self.cache.clear()
+        self._adaptation = adaptation
+
+    @property
+    def ranking(self):
+        """What the matches are ranked by: their 'similarity' to the
+        query, or their similarity once 'adapted' to it."""
+        return self._ranking
+
+    @ranking.setter
+    def ranking(self, ranking):
+        if not ranking in self.rankings:
+            raise ValueError("Unknown ranking: '%s'." % ranking)
+        self.close()
+        self.cache.clear()
+        self._ranking = ranking
+
+    @property
+    def cache_size(self):
+        """Number of results kept in the result cache (0 to disable
+        it)."""
+        return self.cache.size
+
+    @cache_size.setter
+    def cache_size(self, size):
+        self.cache.size = size
+
+    @property
+    def workers(self):
+        """Number of worker processes to split the case base between.
+        With less than two workers, matching is done in-process."""
+        return self._workers
+
+    @workers.setter
+    def workers(self, workers):
+        if workers < 0:
+            raise ValueError("Number of workers cannot be negative.")
+        self.close()
+        self._workers = workers
+
+    def close(self):
+        """Stop worker processes, if any are running. They are
+        restarted on the next match."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def refresh(self):
+        """Pick up changes to the case base. If the cases are a case
+        store whose file has been updated (see store.update_store()),
+        the new version is opened, and the attribute ranges are set
+        from it. The distance table stored with it is loaded again as
+        well, since it is extended with the regions of new cases (see
+        parser.update_cases()). Returns whether the case base
+        changed."""
+        changed = getattr(self.cases, 'changed', None)
+        if changed is None or not changed():
+            return False
+        place.load_distance_table(place.distance_table_path(self.cases.filename))
+        cases = self.cases.reopen()
+        set_ranges(cases.ranges)
         self.cases = cases
+        self.ranges = dict(cases.ranges)
+        return True
+
+    def find_case(self, key):
+        """Index of the case with the given key (a JourneyCode value or
+        attribute), or -1 if there is none."""
+        if not isinstance(key, BaseAttribute):
+            key = getattr(attribute_names, self.key).create(key)
+        if self._keys.indexed(key):
+            return self._keys.find(key)
+        if isinstance(self.cases, CaseTable):
+            return self.cases.find(self.key, key)
+        for i,case in enumerate(self.cases):
+            if self.key in case and case[self.key] == key:
+                return i
+        return -1
+
+    def next_key(self):
+        """A key value that no case has yet."""
+        keys = [0]
+        columns = getattr(self.cases, 'columns', None)
+        if columns is not None:
+            column = columns.get(self.key)
+            if isinstance(column, NumberColumn):
+                keys.extend(column.numbers)
+            elif column is not None:
+                keys.extend([v.value for v in column.values])
+        else:
+            keys.extend([case[self.key].value for case in self.cases if self.key in case])
+        return max(keys) + 1
+
+    def add_case(self, case):
+        """Add a case to the case base (the 'retain' step of CBR). A
+        case without a JourneyCode gets the next free one. Raises
+        ValueError if a case with the same JourneyCode exists. Returns
+        the added case."""
+        case = Case(case)
+        if not self.key in case:
+            case[self.key] = self.next_key()
+        elif self.find_case(case[self.key]) >= 0:
+            raise ValueError("A case with %s %s already exists." % (self.key, case[self.key].value))
+        cases = self._writable_cases()
+        cases.append(case)
+        self._keys.add(len(cases)-1, case)
+        if self._columns is not None:
+            self._columns.append(case)
+        if self._index is not None:
+            self._index.add(len(cases)-1, case)
+        self._update_ranges(added=case)
+        return case
+
+    def remove_case(self, key):
+        """Remove the case with the given key (see find_case()) from
+        the case base. Raises KeyError if there is no such case.
+        Returns the removed case."""
+        index = self.find_case(key)
+        if index < 0:
+            raise KeyError(key)
+        cases = self._writable_cases()
+        case = Case(cases[index])
+        if isinstance(cases, CaseTable):
+            cases.remove(index)
+        else:
+            del cases[index]
+        self._keys.remove(index, case)
+        if self._columns is not None:
+            self._columns.remove(index)
+        if self._index is not None:
+            self._index.remove(index, case)
+        self._update_ranges(removed=case)
+        return case
+
+    def replace_case(self, case):
+        """Replace the case with the same JourneyCode as case. Raises
+        KeyError if there is no such case. Returns the old case."""
+        case = Case(case)
+        index = self.find_case(case[self.key]) if self.key in case else -1
+        if index < 0:
+            raise KeyError(case.get(self.key))
+        cases = self._writable_cases()
+        old_case = Case(cases[index])
+        if isinstance(cases, CaseTable):
+            cases.replace(index, case)
+        else:
+            cases[index] = case
+        self._keys.replace(index, case, old_case)
+        if self._columns is not None:
+            self._columns.replace(index, case)
+        if self._index is not None:
+            self._index.replace(index, case, old_case)
+        self._update_ranges(added=case, removed=old_case)
+        return old_case
+
+    def _writable_cases(self):
+        """Prepare for a change to the case base, and return it.
+
+        The cases are copied before the first change, so the case
+        base given to the matcher (which may be shared with other
+        matchers) is never changed. A case store is copied into
+        memory; later changes to the store file are then no longer
+        picked up. Worker processes are stopped, and get the changed
+        case base when they are restarted. The range statistics are
+        built before the first change."""
+        self.close()
+        self.cache.clear()
+        if self.ranges is not None and self._statistics is None:
+            self._statistics = RangeStatistics(self._cases, self.ranges)
+        cases = self._cases
+        if not self._copied:
+            if isinstance(cases, CaseTable):
+                cases = cases.copy()
+            else:
+                cases = list(cases)
+            self._copied = True
+            self._cases = cases
+            if self._columns is not None:
+                self._columns.cases = cases
+            if self._index is not None:
+                self._index.cases = cases
+            self._keys.cases = cases
+        return cases
+
+    def _update_ranges(self, added=None, removed=None):
+        """Update the attribute ranges after adding and/or removing a
+        case."""
+        if self._statistics is None:
+            return
+        changed = {}
+        if removed is not None:
+            changed.update(self._statistics.remove(removed))
+        if added is not None:
+            changed.update(self._statistics.add(added))
+        if changed:
+            self.ranges.update(changed)
+            set_ranges(changed)
+
+    @property
+    def columns(self):
+        """Columnar encoding of the case base, built on first use."""
+        if self._columns is None:
+            self._columns = CaseColumns(self.cases)
+        return self._columns
+
+    @property
+    def index(self):
+        """Index of the case base for the retrieval mode, built on
+        first use."""
+        if self._index is None:
+            self._index = self.retrieval_indexes[self.retrieval](self.cases, self._keys)
+        return self._index
+
+    def retrieve(self, query, count, adapt=False):
+        """Match a query to the case base, and if adapt is set, adapt
+        the best match to it (see adapted()). Results are cached, so
+        repeating a query does not match it again, unless the case
+        base has changed."""
+        self.refresh()
+        key = query_key(query)
+        if key is not None:
+            key = (key, count, bool(adapt))
+        result = self.cache.get(key)
+        if result is None:
+            best = self._match_many_indices([query], count)[0]
+            result = self._result(best)
+            if adapt:
+                result = self.adapted(query, result, [i for (sim, i) in best])
+            self.cache.put(key, result)
+        return list(result)
 
     def match(self, query, count):
         """Match a query to the case base and return the best matches."""
-        # Construct a list of tuples (similarity, case) from all cases
-        # in the case base.
-        similarities = list(zip(list(map(query.similarity, self.cases)), self.cases))
+        self.refresh()
+        return self._result(self._match_many_indices([query], count)[0])
+
+    def match_many(self, queries, count):
+        """Match a list of queries to the case base. Returns a list
+        with the best matches for each query, in the format of
+        match()."""
+        self.refresh()
+        return [self._result(best) for best in self._match_many_indices(queries, count)]
+
+    def _match_many_indices(self, queries, count):
+        """Match a list of queries to the case base, in the worker
+        processes if there are any."""
+        if self.workers > 1 and len(self.cases) > 1:
+            if self._pool is None:
+                self._pool = ShardPool(self.cases, self.workers, self.engine,
+                                       self.retrieval, self.probes, self.ranking)
+            # Queries answered by the key indexes are not sent to the
+            # workers.
+            return self._match_keys(queries, count, self._pool.match_many)
+        if len(queries) == 1:
+            return [self.match_indices(queries[0], count)]
+        return self.match_many_indices(queries, count)
+
+    def _match_keys(self, queries, count, match_many):
+        """Match the queries that can be answered by the key indexes
+        (see KeyIndex.match()), and the rest by calling
+        match_many(queries, count)."""
+        results = [None]*len(queries)
+        if self.ranking == "similarity":
+            results = [self._keys.match(query, count) for query in queries]
+        rest = [i for (i,best) in enumerate(results) if best is None]
+        if rest:
+            for i,best in zip(rest, match_many([queries[i] for i in rest], count)):
+                results[i] = best
+        return results
+
+    def _result(self, best):
+        """The matches best, as (similarity, case) tuples. The cases of
+        a case table are copied out of it, since the table changes
+        when cases are added or removed, while the results must not."""
+        if isinstance(self.cases, CaseTable):
+            return [(sim, Case(self.cases[i])) for (sim, i) in best]
+        return [(sim, self.cases[i]) for (sim, i) in best]
+
+    def match_many_indices(self, queries, count):
+        """Match a list of queries to the case base in this process.
+        With the numpy engine, all queries are compared to the case
+        base in one pass."""
+        if self.engine == "numpy" and self.retrieval == "scan" and self.ranking == "similarity":
+            partial = count*self.partial_factor < len(self.cases)
+            return self._match_keys(queries, count,
+                                    lambda rest, count: self.columns.match_many(rest, count, partial))
+        return [self.match_indices(query, count) for query in queries]
+
+    def match_indices(self, query, count):
+        """Match a query to the case base in this process. Returns
+        the best matches as (similarity, index) tuples."""
+        if self.ranking == "adapted":
+            return self._match_adapted(query, count)
+        best = self._keys.match(query, count)
+        if best is not None:
+            return best
+        if self.retrieval == "approximate":
+            return self.index.match(query, count, self.probes)
+        if self.retrieval != "scan":
+            return self.index.match(query, count)
+
+        partial = count*self.partial_factor < len(self.cases)
+        if self.engine == "numpy":
+            return self.columns.match(query, count, partial)
+
+        # The query is compiled once, instead of being worked out
+        # again for every case.
+        similarity = query.compile()
+        if partial:
+            # Keep only the count best (similarity, index) tuples in a
+            # heap while streaming over the case base. nlargest() is
+            # stable like sorted(), so cases with equal similarity
+            # stay in case base order.
+            return heapq.nlargest(count, zip(map(similarity, self.cases), range(len(self.cases))),
+                                  key=itemgetter(0))
+
+        # Construct a list of tuples (similarity, index) from all
+        # cases in the case base.
+        similarities = list(zip(list(map(similarity, self.cases)), range(len(self.cases))))
 
         # Return the count first elements of the sorted list of
         # similarities (sorted() sorts on the first element of the
         # tuple).
         return sorted(similarities, key=lambda x: x[0], reverse=True)[:count]
 
-    def adapt(self, query, result):
+    def _match_adapted(self, query, count):
+        """Match a query to the case base, ranking the cases by their
+        similarity after adapting them to the query. Cases that cannot
+        be adapted are ranked by their own similarity."""
+        if self.engine == "numpy":
+            similarities = self.columns.adapted_similarity(query)
+            if similarities is not None:
+                partial = count*self.partial_factor < len(self.cases)
+                order = best_indices(similarities, count, partial)
+                return [(float(similarities[i]), int(i)) for i in order]
+
+        similarity = query.compile()
+        def adapted_similarity(case):
+            try:
+                return similarity(case.adapt(query))
+            except ValueError:
+                return similarity(case)
+        return heapq.nlargest(count, zip(map(adapted_similarity, self.cases), range(len(self.cases))),
+                              key=itemgetter(0))
+
+    def adapted(self, query, result, indices=None):
+        """result with the best match adapted to query (see adapt())
+        added in front of it, if it can be adapted."""
+        if result:
+            try:
+                return [self.adapt(query, result, indices)] + result
+            except AdaptationError:
+                pass
+        return result
+
+    def adapt(self, query, result, indices=None):
         """Adapt a result to a query, if possible.
 
+        With the 'best' adaptation mode, the best match is adapted.
+        With 'all', every match in the result is adapted, and the
+        adapted case most similar to the query is used.
+
         The return value is a tuple ('adapted', case), to conform to
-        the format of the return values of match()."""
+        the format of the return values of match(). indices are the
+        indices of the matches in the case base, if known."""
         if not result:
             raise AdaptationError("Cannot adapt from empty result")
+        if self.adaptation == "all":
+            return self._adapt_all(query, result, indices)
         # result is assumed to be the result of a call to match(), so
         # get the Case element of the best match (i.e. the first
         # element).
@@ -59,3 +649,49 @@ class Matcher(object):
         if query.similarity(adapted) < sim:
             raise AdaptationError("Adapted result is worse than best match")
         return ('adapted', adapted)
+
+    def _adapt_all(self, query, result, indices=None):
+        """Adapt all matches in result, and return the best adapted
+        case. With numpy, all matches are adapted at once, with array
+        operations (see CaseColumns.adapt()), and only the best one is
+        made into a case."""
+        adapted = None
+        if CaseColumns is not None:
+            if indices is not None:
+                # The indices of the matches in the case base are
+                # known, so their columns are taken from the columns
+                # of the case base.
+                columns = self.columns.take(indices)
+            else:
+                columns = CaseColumns([case for (sim, case) in result])
+            adapted = columns.adapt(query)
+        if adapted is None:
+            similarities, candidates = self._adapt_each(query, result)
+        else:
+            similarities, candidates = adapted[0].tolist(), adapted[1].tolist()
+        best = None
+        for i,candidate in enumerate(candidates):
+            if candidate and (best is None or similarities[i] > similarities[best]):
+                best = i
+        if best is None:
+            raise AdaptationError("No adaptable values differ")
+        if similarities[best] < result[0][0]:
+            raise AdaptationError("Adapted result is worse than best match")
+        return ('adapted', result[best][1].adapt(query))
+
+    def _adapt_each(self, query, result):
+        """Adapt the matches in result one at a time. Returns the
+        similarities of the adapted cases to query, and whether each
+        case could be adapted, like CaseColumns.adapt()."""
+        similarities = []
+        candidates = []
+        for sim,case in result:
+            adaptable = [k for (k,v) in list(query.items()) if v.adaptable and k in case and query[k] != case[k]]
+            try:
+                adapted = case.adapt(query)
+            except ValueError:
+                adaptable = None
+            similarities.append(query.similarity(adapted) if adaptable else 0.0)
+            candidates.append(bool(adaptable))
+        return similarities, candidates
+
@@ -21,6 +21,8 @@
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import csv, re, pprint, os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 try:
     import pickle as pickle
 except ImportError:
@@ -28,32 +30,135 @@ except ImportError:
 
 
 
+# Splits camel-cased values into words, and normalises spaces.
+camel_case_re = re.compile(r"(.)([A-Z])")
+spaces_re = re.compile(r"\s+")
+
 def parse_csv(filename):
-    with open(filename, "rb") as fp:
-        reader = csv.reader(fp, delimiter=",", quotechar='"')
-        return parse_items(reader)
+    return list(iter_csv(filename))
 
 def parse_cases(filename):
-    with open(filename, "r") as fp:
-        return parse_items([i.split(None, 1) for i in fp])
+    return list(iter_cases(filename))
 
 def parse_items(lines):
-    items = []
+    return list(iter_items(lines))
+
+def load_queries(filename):
+    """Create a query case for each item of a .cases or .csv file.
+    Items that are not valid cases are skipped with a message. Raises
+    IOError if the file cannot be read."""
+    from case import Case
+    if filename.endswith(".csv"):
+        items = parse_csv(filename)
+    else:
+        items = parse_cases(filename)
+    queries = []
+    for i,item in enumerate(items):
+        try:
+            queries.append(Case(item))
+        except (KeyError, ValueError) as e:
+            print("Skipping query %d: %s" % (i+1, e))
+    return queries
+
+def iter_csv(filename):
+    """Generator yielding the items of a .csv file one at a time."""
+    for record in iter_records(filename, True):
+        yield parse_item(record)
+
+def iter_cases(filename):
+    """Generator yielding the items of a .cases file one at a time."""
+    for record in iter_records(filename, False):
+        yield parse_item(record)
+
+def iter_items(lines):
+    """Generator yielding an item for each 'defcase' section of lines."""
+    for record in split_records(lines):
+        yield parse_item(record)
+
+def iter_records(filename, csv_format=None):
+    """Generator yielding the unparsed records of a .csv or .cases
+    file (by default, the format is chosen by the file extension)."""
+    if csv_format is None:
+        csv_format = filename.endswith(".csv")
+    if csv_format:
+        with open(filename, "r", newline="") as fp:
+            reader = csv.reader(fp, delimiter=",", quotechar='"')
+            for record in split_records(reader):
+                yield record
+    else:
+        with open(filename, "r") as fp:
+            for record in split_records(line.split(None, 1) for line in fp):
+                yield record
+
+def split_records(lines):
+    """Generator yielding the lines of each 'defcase' section of lines
+    as a list. Only the lines of the current record are kept in
+    memory."""
     current_item = []
     for line in lines:
         if not line:
             continue
         if line[0] == "defcase":
             if current_item:
-                items.append(parse_item(current_item))
+                yield current_item
             current_item = []
         elif [i for i in line if i]:
             current_item.append(line)
 
     if current_item:
-        items.append(parse_item(current_item))
+        yield current_item
+
+def iter_chunks(records, size=1000):
+    """Group records into chunks of up to size records. Yields (number
+    of records before the chunk, list of records) tuples."""
+    start = 0
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield (start, chunk)
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        yield (start, chunk)
+
+def map_chunks(function, chunks, workers=1):
+    """Generator yielding function(chunk) for each of the chunks, in
+    order. If workers is more than one, the chunks are processed in a
+    pool of that many processes. At most two chunks per worker are
+    read ahead of the results."""
+    if workers <= 1:
+        for chunk in chunks:
+            yield function(chunk)
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(function, chunk))
+            if len(pending) >= 2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
-    return items
+def scan_chunk(chunk):
+    """ItemStatistics of a chunk of records."""
+    start,records = chunk
+    return ItemStatistics([parse_item(record) for record in records])
+
+def build_chunk(chunk):
+    """Parse a chunk of records and create a case for each of them.
+    Returns a CaseTable of the valid cases, and a list of (record
+    number, error message) tuples for the invalid ones."""
+    from case import Case, CaseTable
+    start,records = chunk
+    cases = CaseTable()
+    errors = []
+    for i,record in enumerate(records):
+        try:
+            cases.append(Case(parse_item(record)))
+        except (KeyError, ValueError) as e:
+            errors.append((start+i+1, e.args[0] if e.args else str(e)))
+    return cases, errors
 
 def parse_item(lines):
     item = {}
@@ -72,82 +177,215 @@ def parse_item(lines):
             key = key.strip(" :")
             value = value.strip('" .,\n"')
             # Break apart camel-cased values into words.
-            value = re.sub(r"(.)([A-Z])", r"\1 \2", value)
+            value = camel_case_re.sub(r"\1 \2", value)
             # Normalise spaces
-            value = re.sub(r"\s+", r" ", value)
+            value = spaces_re.sub(r" ", value)
             item[key] = value
     return item
 
+class ItemStatistics(object):
+    """Statistics of a stream of items, updated one item at a time:
+    the number of items, the range of each numeric attribute and the
+    distinct values of each categorical attribute."""
+
+    numeric = ('Price', 'NumberOfPersons', 'Duration')
+    categorical = ('Accommodation', 'Transportation', 'HolidayType', 'Region')
+
+    def __init__(self, items=[]):
+        self.count = 0
+        self.limits = {}
+        self.values = dict([(key, set()) for key in self.categorical])
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        self.count += 1
+        for key in self.numeric:
+            if key in item:
+                try:
+                    value = float(item[key])
+                except ValueError:
+                    # Reported when the case is created.
+                    continue
+                if key in self.limits:
+                    low,high = self.limits[key]
+                    self.limits[key] = (min(low, value), max(high, value))
+                else:
+                    self.limits[key] = (value, value)
+        for key in self.categorical:
+            if key in item:
+                self.values[key].add(item[key])
+
+    def merge(self, other):
+        """Add the statistics of other to these statistics."""
+        self.count += other.count
+        for key,(low,high) in list(other.limits.items()):
+            if key in self.limits:
+                self.limits[key] = (min(self.limits[key][0], low), max(self.limits[key][1], high))
+            else:
+                self.limits[key] = (low, high)
+        for key,values in list(other.values.items()):
+            self.values[key].update(values)
+
+    def ranges(self):
+        """(min, max) of each numeric attribute found in the items."""
+        return dict([(key, self.limits[key]) for key in self.numeric if key in self.limits])
+
+def build_cases(filename, workers=1):
+    """Create a CaseTable from the records of filename. Raises a
+    RuntimeError listing the records that could not be parsed."""
+    from case import CaseTable
+    cases = CaseTable()
+    errors = []
+    # The chunks are merged in order, which gives the same case table
+    # as creating the cases one by one.
+    for chunk_cases,chunk_errors in map_chunks(build_chunk,
+                                               iter_chunks(iter_records(filename)),
+                                               workers):
+        cases.extend(chunk_cases)
+        errors.extend(chunk_errors)
+        print("  %d cases created..." % len(cases))
+    if errors:
+        for number,message in errors:
+            print("  Record %d: %s" % (number, message))
+        raise RuntimeError("Unable to create cases for %d records." % len(errors))
+    return cases
+
+def update_cases(mode, filename, output, workers=1):
+    """Update the existing case store output with the records of
+    filename, identified by their JourneyCode. mode is one of:
+
+    - 'append': add the cases, which must not already be in the store.
+    - 'upsert': add the cases, replacing those already in the store.
+    - 'delete': remove the cases with the same JourneyCode."""
+    import place
+    from attribute_names import JourneyCode
+    from store import update_store
+
+    if output.endswith(".pickle") or not os.path.exists(output):
+        raise RuntimeError("Only existing case stores can be updated: %s" % output)
+    # New regions are added to the distance table stored with the
+    # output, not to the one loaded from the current directory.
+    distance_filename = place.distance_table_path(output)
+    place.distance_table = place.DistanceTable()
+    place.load_distance_table(distance_filename)
+    distances = len(place.distance_table.coords)
+    try:
+        if mode == 'delete':
+            items = [parse_item(record) for record in iter_records(filename)]
+            codes = [JourneyCode.create(item['JourneyCode']).encode()
+                     for item in items if 'JourneyCode' in item]
+            result = update_store(output, delete=codes)
+        else:
+            stats = ItemStatistics()
+            for chunk_stats in map_chunks(scan_chunk, iter_chunks(iter_records(filename)), workers):
+                stats.merge(chunk_stats)
+            looked_up,missing = place.geocode_all(stats.values['Region'])
+            if missing:
+                raise RuntimeError("Unable to find locations: %s" % ", ".join(sorted(missing)))
+            # New regions are added to the distance table, so their
+            # distances to the other regions are geodesic. So are the
+            # regions already in the store, if it has no table yet.
+            from store import CaseStore
+            column = CaseStore(output).columns.get('Region')
+            for attr in (column.values if column is not None else []):
+                place.distance_table.add(attr.value.coords)
+            for name in sorted(stats.values['Region']):
+                place.distance_table.add(place.Place(name).coords)
+            cases = build_cases(filename, workers)
+            result = update_store(output, cases, replace=(mode == 'upsert'))
+    except ValueError as e:
+        raise RuntimeError(str(e))
+    added,replaced,deleted,missing = result
+    print("Added %d, replaced %d and deleted %d cases in %s." % (added, replaced, deleted, output))
+    if missing:
+        print("JourneyCodes not found: %s" % ", ".join(map(str, missing)))
+    if len(place.distance_table.coords) > distances:
+        place.distance_table.save(distance_filename)
+
 if __name__ == "__main__":
     try:
         import sys
+        import place
         from place import Place
-        if len(sys.argv) < 2:
-            print("Usage: %s <filename>." % sys.argv[0])
+        args = sys.argv[1:]
+        mode = None
+        if args and args[0] in ("--append", "--upsert", "--delete"):
+            mode = args.pop(0)[2:]
+        if len(args) < 1:
+            print("Usage: %s [--append|--upsert|--delete] <filename> [output] [workers]." % sys.argv[0])
+            print("The output file defaults to cases.store; give a .pickle file to pickle the cases.")
+            print("The input is parsed by a number of worker processes (default: one per CPU).")
+            print("With --append, --upsert or --delete, the cases in the file are added to,")
+            print("replaced in or deleted from an existing case store, by JourneyCode.")
             sys.exit(1)
         else:
-            filename = sys.argv[1]
-
-        if filename.endswith(".csv"):
-            items = parse_csv(filename)
+            filename = args[0]
+        if len(args) > 1:
+            output = args[1]
+        else:
+            output = "cases.store"
+        if len(args) > 2:
+            workers = int(args[2])
         else:
-            items = parse_cases(filename)
-        print("Parsed %d items" % len(items))
+            workers = os.cpu_count() or 1
 
-        ranges = {}
+        if mode is not None:
+            update_cases(mode, filename, output, workers)
+            sys.exit(0)
 
-        prices = [float(i['Price']) for i in items if 'Price' in i]
-        ranges['Price'] = (min(prices), max(prices))
-        people = [float(i['NumberOfPersons']) for i in items if 'NumberOfPersons' in i]
-        ranges['NumberOfPersons'] = (min(people),max(people))
-        durations = [float(i['Duration']) for i in items if 'Duration' in i]
-        ranges['Duration'] = (min(durations),max(durations))
+        # The file is read twice: once to find the ranges and the
+        # regions to look up, and once to create the cases. Records
+        # are split into chunks, which are parsed by the workers, and
+        # not kept in memory between the two passes.
+        stats = ItemStatistics()
+        for chunk_stats in map_chunks(scan_chunk, iter_chunks(iter_records(filename)), workers):
+            stats.merge(chunk_stats)
+        print("Parsed %d items" % stats.count)
 
+        ranges = stats.ranges()
 
-        print("Accommodation:", sorted(list(set([i['Accommodation'] for i in items if 'Accommodation' in i]))))
-        print("Transportation:", sorted(list(set([i['Transportation'] for i in items if 'Transportation' in i]))))
-        print("HolidayType:", sorted(list(set([i['HolidayType'] for i in items if 'HolidayType' in i]))))
-        regions = list(set([i['Region'] for i in items if 'Region' in i]))
+        print("Accommodation:", sorted(stats.values['Accommodation']))
+        print("Transportation:", sorted(stats.values['Transportation']))
+        print("HolidayType:", sorted(stats.values['HolidayType']))
+        # Sorted, so the distance table is the same on every run.
+        regions = sorted(stats.values['Region'])
+        # Look up all regions at once before creating any places or
+        # cases, so lookups that are not cached run concurrently.
+        looked_up,missing = place.geocode_all(regions)
+        print("Looked up %d regions not in the location cache." % looked_up)
+        if missing:
+            raise RuntimeError("Unable to find locations: %s" % ", ".join(sorted(missing)))
         regions = [(i, Place(i)) for i in regions]
+        # Precompute the distances between all regions, which are
+        # stored for use when matching.
+        place.distance_table = place.DistanceTable([p.coords for (n,p) in regions])
         pp = pprint.PrettyPrinter(indent=4)
         print("Region:", end=' ')
         pp.pprint(sorted(regions))
-        max_distance = 0.0
-        min_distance = 10000.0
-        max_regions = []
-        max_direct_distance = 0.0
-        for region in regions:
-            for other_region in regions:
-                if not region==other_region:
-                    distance = region[1].latitudal_distance(other_region[1])
-                    min_distance = min([min_distance,distance])
-                    direct_distance = region[1].distance(other_region[1])
-                    if direct_distance > max_direct_distance:
-                        max_direct_distance = direct_distance
-                    if distance > max_distance:
-                        max_distance = distance
-                        max_regions = [region,other_region]
-        ranges['Region'] = (min_distance, max_distance, max_direct_distance)
+        ranges['Region'] = place.region_range([p for (n,p) in regions])
         for k,v in list(ranges.items()):
             print("%s: %f-%f, %f" % (k, v[0], v[1], v[1]-v[0]))
 
         print("Max direct distance: %f km" % ranges['Region'][2])
 
-        filename = "cases.pickle"
-        if os.path.exists(filename):
-            print("Case storage file %s exists. Not creating cases." % filename)
+        if os.path.exists(output):
+            print("Case storage file %s exists. Not creating cases (use --append or --upsert to update it)." % output)
         else:
-            print("Creating and storing Case objects in %s:" % filename)
-            from case import Case
-            cases = []
-            for i,item in enumerate(items):
-                cases.append(Case(item))
-                if (i+1)%100 == 0:
-                    print("  %d cases created..." % (i+1))
+            print("Creating and storing Case objects in %s:" % output)
+            from store import write_store
+            cases = build_cases(filename, workers)
             print("  Storing cases...", end=' ')
-            with open(filename, "wb") as fp:
-                pickle.dump((ranges,cases), fp, -1)
-                print("done.")
+            if output.endswith(".pickle"):
+                with open(output, "wb") as fp:
+                    pickle.dump((ranges,cases), fp, -1)
+            else:
+                write_store(output, cases, ranges)
+            print("done.")
+            distance_filename = place.distance_table_path(output)
+            print("Storing distances between %d regions in %s." % (len(place.distance_table.coords),
+                                                                   distance_filename))
+            place.distance_table.save(distance_filename)
     except RuntimeError as e:
         sys.stderr.write("Fatal error occurred: %s\n" % e)
         sys.exit(1)
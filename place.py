@@ -19,74 +19,343 @@
 ## You should have received a copy of the GNU General Public License
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, atexit
+import math, os, sqlite3, threading
+from concurrent.futures import ThreadPoolExecutor
 try:
     import pickle as pickle
 except ImportError:
     import pickle
 
 try:
-    from geopy import geocoders, distance
+    import numpy
 except ImportError:
-    raise RuntimeError("Could not find geopy library. See http://code.google.com/p/geopy/.")
+    numpy = None
 
-try:
-    geocoder = geocoders.Google(domain="maps.google.co.uk")
-except AttributeError:
-    geocoder = geocoders.GoogleV3(domain="maps.google.co.uk")
-location_cache_filename = "location_cache.pickle"
+from geocoding import Gazetteer, RemoteGeocoder, RateLimitedGeocoder, \
+    FallbackGeocoder, correction_table
 
+# Places are looked up in the local gazetteer first, and then with the
+# remote geocoder, which needs geopy and network access. Remote lookups
+# are limited to 10 per second, also when looking up places from
+# several threads.
+geocoder = FallbackGeocoder([Gazetteer(), RateLimitedGeocoder(RemoteGeocoder(), 10.0)])
+location_cache_filename = "location_cache.db"
+old_location_cache_filename = "location_cache.pickle"
+distance_table_filename = "distances.pickle"
 
-def save_location_cache(filename=location_cache_filename):
-    import place
-    with open(filename, "wb") as fp:
-        pickle.dump(place.location_cache, fp, -1)
 
-atexit.register(save_location_cache)
+class LocationCache(object):
+    """Persistent cache of geocoder results, mapping search keys to
+    (place name, coordinates) tuples.
 
-location_cache = {}
+    The cache is stored in an SQLite database. Entries are looked up
+    when they are needed, and every new entry is written to the
+    database straight away, so nothing is lost if the program is
+    stopped. SQLite handles locking, so several processes can use the
+    same cache file at once.
 
-if os.path.exists(location_cache_filename):
-    with open(location_cache_filename, "rb") as fp:
-        try:
-            location_cache = pickle.load(fp, encoding="utf-8")
-        except pickle.UnpicklingError:
+    When the database is created, the entries of the old pickled
+    cache file are imported into it."""
+
+    def __init__(self, filename=location_cache_filename,
+                 old_filename=old_location_cache_filename):
+        self.filename = filename
+        self.old_filename = old_filename
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """The database connection of this process. Connections are
+        not shared with forked processes, so a new one is opened if
+        the process has changed."""
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.filename, timeout=30.0,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            try:
+                # Let readers run concurrently with a writer.
+                connection.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.DatabaseError:
                 pass
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                exists = connection.execute("SELECT 1 FROM sqlite_master WHERE "
+                                            "type='table' AND name='locations'").fetchone()
+                if not exists:
+                    connection.execute("CREATE TABLE locations (key TEXT PRIMARY KEY, "
+                                       "place_name TEXT, latitude REAL, longitude REAL)")
+                    self._migrate(connection)
+                connection.execute("COMMIT")
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def _migrate(self, connection):
+        """Import the entries of the old pickled cache, if it exists."""
+        if not os.path.exists(self.old_filename):
+            return
+        with open(self.old_filename, "rb") as fp:
+            try:
+                entries = pickle.load(fp, encoding="utf-8")
+            except (pickle.UnpicklingError, EOFError):
+                return
+        connection.executemany("INSERT OR IGNORE INTO locations VALUES (?, ?, ?, ?)",
+                               [self._row(k, v) for (k,v) in list(entries.items())])
+
+    def _row(self, key, location):
+        place_name, coords = location
+        if coords is None:
+            return (key, place_name, None, None)
+        return (key, place_name, coords[0], coords[1])
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._connect().execute("SELECT place_name, latitude, longitude "
+                                          "FROM locations WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return default
+        place_name, latitude, longitude = row
+        if latitude is None:
+            return (place_name, None)
+        return (place_name, (latitude, longitude))
+
+    def __getitem__(self, key):
+        location = self.get(key)
+        if location is None:
+            raise KeyError(key)
+        return location
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, location):
+        with self._lock:
+            self._connect().execute("INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?)",
+                                    self._row(key, location))
+
+    def update(self, locations):
+        """Add all (key, location) pairs in locations in a single
+        transaction."""
+        rows = [self._row(k, v) for (k,v) in list(locations)]
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany("INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?)", rows)
+                connection.execute("COMMIT")
+            except:
+                connection.execute("ROLLBACK")
+                raise
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM locations").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+location_cache = LocationCache()
+
+
+def geodesic_distance(a, b):
+    """Distance in km between the coordinates a and b. This uses geopy
+    if it is installed, and otherwise the great circle distance."""
+    try:
+        from geopy import distance
+    except ImportError:
+        return great_circle_distance(a, b)
+    return distance.distance(a, b).km
+
+def great_circle_distance(a, b, radius=6371.009):
+    lat1, lon1 = math.radians(a[0]), math.radians(a[1])
+    lat2, lon2 = math.radians(b[0]), math.radians(b[1])
+    h = math.sin((lat2-lat1)/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin((lon2-lon1)/2)**2
+    return 2*radius*math.asin(min(1.0, math.sqrt(h)))
+
+def great_circle_distances(a, coords, radius=6371.009):
+    """Great circle distances in km from a to each of the coordinates
+    in coords, as a list. With numpy, they are all computed at once."""
+    if numpy is None or not coords:
+        return [great_circle_distance(a, b, radius) for b in coords]
+    lat1, lon1 = math.radians(a[0]), math.radians(a[1])
+    points = numpy.radians(numpy.array(coords, dtype=numpy.float64))
+    lat2, lon2 = points[:,0], points[:,1]
+    h = numpy.sin((lat2-lat1)/2)**2 + math.cos(lat1)*numpy.cos(lat2)*numpy.sin((lon2-lon1)/2)**2
+    return (2*radius*numpy.arcsin(numpy.minimum(1.0, numpy.sqrt(h)))).tolist()
+
 
+class DistanceTable(object):
+    """Table of geodesic distances (in km) between places.
 
-# Table of replacement keys to get the right place results on a google
-# search. Source: Wikipedia :)
-correction_table = {"fano": "fanø",
-                     "czechia": "czech republic",
-                     "erz gebirge": "erzgebirge",
-                     "turkish aegean sea": "aegean sea",
-                     "riviera": "french riviera",
-                     "turkish riviera": "istanbul", # close enough
-                     "costa blanca": "costa blance, spain",
-                     "teneriffe": "tenerife",
-                     "salzberger land": "salzburg",
-                     "costa brava": "costa brava, spain",
-                     "atlantic": "bordeaux", # It's by the Atlantic, in France
-                     "algarve": "algarve, portugal",
-                     }
+    Places are identified by their coordinates. The table is
+    precomputed for the regions of the case base by parser.py, and
+    stored next to the case store. If a distance from a place not in
+    the table (e.g. a region only used in a query) is needed, the
+    great circle distances from that place to all places in the table
+    are computed at once. These are kept for the last extra_size such
+    places, apart from the table, which does not change.
+
+    The latitude part of the Region similarity is not kept in the
+    table, since it depends on the Region range, which changes with
+    the case base, and only takes a few arithmetic operations."""
+
+    extra_size = 256
+
+    def __init__(self, coords=[]):
+        self.coords = []
+        self.codes = {}
+        self.distances = []
+        self.extra = {}
+        for c in coords:
+            self.add(c)
+
+    def add(self, coords):
+        """Add a place to the table, if it is not already there.
+        Returns the index of the place in the table."""
+        code = self.codes.get(coords)
+        if code is None:
+            code = len(self.coords)
+            for i,c in enumerate(self.coords):
+                self.distances[i].append(geodesic_distance(c, coords))
+            self.coords.append(coords)
+            self.codes[coords] = code
+            self.distances.append([geodesic_distance(coords, c) for c in self.coords])
+            self.extra.clear()
+        return code
+
+    def distance(self, a, b):
+        """Distance between the places with coordinates a and b."""
+        code_a = self.codes.get(a)
+        code_b = self.codes.get(b)
+        if code_a is not None and code_b is not None:
+            return self.distances[code_a][code_b]
+        if code_b is None:
+            a,b,code_b = b,a,code_a
+        if code_b is None:
+            return great_circle_distance(a, b)
+        return self._distances_from(a)[code_b]
+
+    def _distances_from(self, coords):
+        """Distances from a place not in the table to all places in
+        it."""
+        distances = self.extra.get(coords)
+        if distances is None:
+            if len(self.extra) >= self.extra_size:
+                self.extra.clear()
+            distances = great_circle_distances(coords, self.coords)
+            self.extra[coords] = distances
+        return distances
+
+    def save(self, filename=distance_table_filename):
+        with open(filename, "wb") as fp:
+            pickle.dump((self.coords, self.distances), fp, -1)
+
+    @classmethod
+    def load(cls, filename=distance_table_filename):
+        table = cls()
+        with open(filename, "rb") as fp:
+            table.coords, table.distances = pickle.load(fp)
+        table.codes = dict([(c,i) for (i,c) in enumerate(table.coords)])
+        return table
+
+def distance_table_path(store_filename):
+    """Filename of the distance table stored with a case store."""
+    return os.path.join(os.path.dirname(store_filename), distance_table_filename)
+
+def load_distance_table(filename=distance_table_filename):
+    """Use the distance table stored in filename, if it exists."""
+    global distance_table
+    if os.path.exists(filename):
+        try:
+            distance_table = DistanceTable.load(filename)
+        except (pickle.UnpicklingError, ValueError, EOFError):
+            pass
+
+distance_table = DistanceTable()
+load_distance_table()
+
+
+def region_range(places):
+    """Range of distances between places, as used for the Region
+    attribute: the minimum and maximum latitudal distance, and the
+    maximum direct distance between any two different places."""
+    max_distance = 0.0
+    min_distance = 10000.0
+    max_direct_distance = 0.0
+    for place in places:
+        for other_place in places:
+            if not place == other_place:
+                min_distance = min([min_distance, place.latitudal_distance(other_place)])
+                max_distance = max([max_distance, place.latitudal_distance(other_place)])
+                max_direct_distance = max([max_direct_distance, place.distance(other_place)])
+    return (min_distance, max_distance, max_direct_distance)
+
+def search_key(name):
+    """The key a place name is looked up and cached under."""
+    key = name.lower()
+    return correction_table.get(key, key)
+
+def geocode_all(names, workers=8, geocoder=None):
+    """Look up all the place names that are not in the location cache,
+    using a pool of worker threads, and add the results to the cache in
+    one go. Places can then be created from the cache without further
+    lookups. Uses the module geocoder unless another one is given.
+
+    Returns the number of names that were looked up, and a list of the
+    names that could not be found."""
+    if geocoder is None:
+        import place
+        geocoder = place.geocoder
+    keys = {}
+    for name in names:
+        key = search_key(name)
+        if not key in keys and location_cache.get(key) is None:
+            keys[key] = name
+
+    def lookup(key):
+        try:
+            return geocoder.geocode(key)
+        except:
+            return None
+
+    found = []
+    missing = []
+    if keys:
+        with ThreadPoolExecutor(max(1, min(workers, len(keys)))) as executor:
+            for key,location in zip(keys, executor.map(lookup, keys)):
+                if location is None:
+                    missing.append(keys[key])
+                else:
+                    found.append((key, location))
+    location_cache.update(found)
+    return len(keys), missing
 
 
 class Place(object):
 
+    __slots__ = ('name', 'place_name', 'coords')
 
     def __init__(self, name):
         self.name = name
-        key = name.lower()
-        if key in correction_table:
-            key = correction_table[key]
-        if not key in location_cache:
+        key = search_key(name)
+        location = location_cache.get(key)
+        if location is None:
             try:
-                search_value = list(geocoder.geocode(key, exactly_one = False))
-                location_cache[key] = search_value[0]
+                location = geocoder.geocode(key)
             except:
-                   raise ValueError("Unable to find location: '%s'" % name)
-                   location_cache[key] = (None,None)
-        self.place_name, self.coords = location_cache[key]
+                location = None
+            if location is None:
+                raise ValueError("Unable to find location: '%s'" % name)
+            location_cache[key] = location
+            location = location_cache[key]
+        self.place_name, self.coords = location
 
     def latitudal_distance(self, other):
         """Latitudal distance between two places."""
@@ -95,7 +364,36 @@ class Place(object):
         return abs(self.coords[0]-other.coords[0])
 
     def distance(self, other):
-        return distance.distance(self.coords, other.coords).km
+        """Geodesic distance between two places, in km. Looked up in
+        the distance table."""
+        return distance_table.distance(self.coords, other.coords)
+
+    @classmethod
+    def from_location(cls, name, place_name, coords):
+        """Create a place from an already looked up location."""
+        place = cls.__new__(cls)
+        place.name = name
+        place.place_name = place_name
+        place.coords = tuple(coords) if coords is not None else None
+        return place
+
+    def __eq__(self, other):
+        """Places are equal if they have the same name and resolve to
+        the same location."""
+        if not isinstance(other, Place):
+            return NotImplemented
+        return self.name == other.name and self.place_name == other.place_name \
+            and self.coords == other.coords
+
+    def __hash__(self):
+        return hash((self.name, self.place_name, self.coords))
+
+    def __getstate__(self):
+        return {'name': self.name, 'place_name': self.place_name, 'coords': self.coords}
+
+    def __setstate__(self, state):
+        for key,value in list(state.items()):
+            setattr(self, key, value)
 
     def __repr__(self):
         return "<Place: %s>" % repr(self.place_name)
@@ -0,0 +1,148 @@
+## -*- coding: utf-8 -*-
+##
+## ranges.py
+##
+## Date:     16 October 2026
+## Copyright (c) 2026, the cbr-system contributors
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Attribute ranges of the case base.
+
+Some attributes scale their similarity by the range of values in the
+case base (the _range class attribute). The ranges are computed when
+the case base is built, stored along with it, and set on the attribute
+classes when it is loaded."""
+
+__all__ = ['set_ranges', 'attribute_range', 'RangeStatistics']
+
+from collections import Counter
+
+import attribute_names
+
+def set_ranges(ranges):
+    """Set the _range of the attribute classes from a dictionary of
+    ranges, as stored in a case store."""
+    for name,value in list(ranges.items()):
+        getattr(attribute_names, name)._range = value
+
+def attribute_range(name, attrs):
+    """Range of the distinct attribute values attrs of the attribute
+    name, or None if there are none. Regions get the distance range of
+    place.region_range(), other attributes the (min, max) of their
+    values."""
+    if not attrs:
+        return None
+    if issubclass(getattr(attribute_names, name), attribute_names.Region):
+        import place
+        return place.region_range([attr.value for attr in attrs])
+    values = [float(attr.value) for attr in attrs]
+    return (min(values), max(values))
+
+def _key(attr):
+    try:
+        return (type(attr), attr._intern_key())
+    except TypeError:
+        return (type(attr), id(attr))
+
+class RangeStatistics(object):
+    """Keeps the ranges of a changing case base up to date.
+
+    The number of cases with each distinct value of the attributes
+    in ranges is counted. A range is widened when a case with a new
+    value is added, and recomputed from the remaining distinct values
+    when the last case with a value is removed. The result is the same
+    as computing the ranges from scratch."""
+
+    def __init__(self, cases, ranges):
+        self.ranges = dict(ranges)
+        self.counts = dict([(name, {}) for name in self.ranges])
+        columns = getattr(cases, 'columns', None)
+        for name,counts in list(self.counts.items()):
+            if columns is not None:
+                # Count by code, instead of by case.
+                if not name in columns:
+                    continue
+                column = columns[name]
+                codes = getattr(column, 'codes', None)
+                if codes is None:
+                    codes = column.numbers
+                    value = column.attribute.decode
+                else:
+                    value = column.values.__getitem__
+                for code,count in list(Counter(codes).items()):
+                    if code >= 0:
+                        self._count(counts, value(code), count)
+            else:
+                for case in cases:
+                    if name in case:
+                        self._count(counts, case[name], 1)
+
+    def _count(self, counts, attr, count):
+        """Add count to the count of attr. Returns True if attr is a
+        new value, and False if the last case with it was removed."""
+        key = _key(attr)
+        if key in counts:
+            counts[key][0] += count
+            if counts[key][0] <= 0:
+                del counts[key]
+                return False
+            return None
+        counts[key] = [count, attr]
+        return True
+
+    def add(self, case):
+        """Count the values of a new case. Returns the ranges that
+        changed."""
+        changed = {}
+        for name,counts in list(self.counts.items()):
+            if name in case and self._count(counts, case[name], 1):
+                attr = case[name]
+                others = [a for (c,a) in list(counts.values()) if _key(a) != _key(attr)]
+                value = self._widen(name, attr, others)
+                if value != self.ranges.get(name):
+                    self.ranges[name] = changed[name] = value
+        return changed
+
+    def remove(self, case):
+        """Stop counting the values of a removed case. Returns the
+        ranges that changed."""
+        changed = {}
+        for name,counts in list(self.counts.items()):
+            if name in case and self._count(counts, case[name], -1) is False:
+                value = attribute_range(name, [a for (c,a) in list(counts.values())])
+                if value is not None and value != self.ranges.get(name):
+                    self.ranges[name] = changed[name] = value
+        return changed
+
+    def _widen(self, name, attr, others):
+        """The range of name, widened to include attr."""
+        current = self.ranges.get(name)
+        if current is None or not others:
+            return attribute_range(name, others + [attr])
+        if issubclass(getattr(attribute_names, name), attribute_names.Region):
+            min_distance, max_distance, max_direct_distance = current
+            place = attr.value
+            for other in [a.value for a in others]:
+                if other == place:
+                    continue
+                # Distances are computed in both directions, like
+                # place.region_range() does.
+                for a,b in ((place, other), (other, place)):
+                    min_distance = min([min_distance, a.latitudal_distance(b)])
+                    max_distance = max([max_distance, a.latitudal_distance(b)])
+                    max_direct_distance = max([max_direct_distance, a.distance(b)])
+            return (min_distance, max_distance, max_direct_distance)
+        value = float(attr.value)
+        return (min(current[0], value), max(current[1], value))
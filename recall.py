@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+## -*- coding: utf-8 -*-
+##
+## recall.py
+##
+## Date:     16 October 2026
+## Copyright (c) 2026, the cbr-system contributors
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the recall of approximate retrieval.
+
+Runs a file of queries (in .cases or .csv format) against the case
+base, both exactly and with approximate retrieval for a number of
+probes settings, and prints the recall@k and the time per query of
+each setting, to help choose the probes setting (config set probes
+<n>)."""
+
+import sys, time
+
+from matcher import Matcher
+from parser import load_queries
+from ranges import set_ranges
+from store import load_cases
+
+default_probes = [1, 2, 4, 8, 16, 32, 64]
+
+def recall(exact, approximate):
+    """Recall of an approximate result, compared to the exact result
+    (both lists of (similarity, index) tuples). A match counts as
+    found if its case is in the approximate result, or if the
+    approximate result has another case with the same similarity in
+    its place, since either could have been the exact result."""
+    if not exact:
+        return 1.0
+    worst = exact[-1][0]
+    found = len([sim for (sim,i) in approximate if sim >= worst])
+    return min(found, len(exact)) / float(len(exact))
+
+def run(matcher, queries, count):
+    """Match each query in turn. Returns the results and the average
+    time per query, in seconds."""
+    start = time.time()
+    results = [matcher.match_indices(query, count) for query in queries]
+    return results, (time.time()-start) / max(len(queries), 1)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: %s <queries> [k] [probes...]." % sys.argv[0])
+        sys.exit(1)
+    try:
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        probes = [int(p) for p in sys.argv[3:]] or default_probes
+    except ValueError:
+        print("k and probes must be numbers.")
+        sys.exit(1)
+    loaded = load_cases()
+    if loaded is None:
+        print("No cases found.")
+        sys.exit(1)
+    cases,ranges = loaded
+    set_ranges(ranges)
+    queries = load_queries(sys.argv[1])
+    print("Matching %d queries against %d cases." % (len(queries), len(cases)))
+
+    matcher = Matcher(cases)
+    exact, seconds = run(matcher, queries, count)
+    print("Exact (%s engine): %.3f ms/query." % (matcher.engine, seconds*1000))
+
+    matcher = Matcher(cases, retrieval="approximate")
+    # Build the index before timing the queries.
+    matcher.index
+    print("%8s %10s %10s" % ("probes", "recall@%d" % count, "ms/query"))
+    for p in probes:
+        matcher.probes = p
+        results, seconds = run(matcher, queries, count)
+        total = sum([recall(e, a) for (e,a) in zip(exact, results)])
+        print("%8d %10.4f %10.3f" % (p, total / max(len(queries), 1), seconds*1000))
@@ -0,0 +1,122 @@
+## -*- coding: utf-8 -*-
+##
+## shards.py
+##
+## Date:     16 October 2026
+## Copyright (c) 2026, the cbr-system contributors
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['ShardPool']
+
+import heapq, inspect, multiprocessing
+from itertools import islice
+
+import attribute_names
+from ranges import set_ranges
+
+def attribute_ranges():
+    """The current _range of every attribute class that has one. These
+    are set at runtime from the case base, so they are passed on to
+    the worker processes explicitly."""
+    return dict([(name, cls._range) for (name, cls) in
+                 inspect.getmembers(attribute_names, inspect.isclass)
+                 if hasattr(cls, '_range')])
+
+def _worker(connection, cases, offset, engine, retrieval, probes, ranking, ranges):
+    """Worker process main loop. Matches queries against a single
+    shard of the case base until told to stop."""
+    from matcher import Matcher
+    set_ranges(ranges)
+    matcher = Matcher(cases, engine, retrieval=retrieval, probes=probes, ranking=ranking)
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        queries, count = request
+        try:
+            result = [[(sim, i+offset) for (sim, i) in best]
+                      for best in matcher.match_many_indices(queries, count)]
+        except Exception as e:
+            result = e
+        connection.send(result)
+    connection.close()
+
+class ShardPool(object):
+    """A persistent pool of worker processes, each holding a
+    contiguous shard of the case base.
+
+    Each shard is handed to its worker once, when the worker is
+    started (with the fork start method, the worker simply inherits
+    it). Queries are sent to all workers in batches, each worker
+    returns its local best matches, and these are merged into the
+    overall result."""
+
+    def __init__(self, cases, workers, engine, retrieval="scan", probes=4, ranking="similarity"):
+        self.size = len(cases)
+        self.connections = []
+        self.processes = []
+        workers = max(1, min(workers, self.size))
+        shard_size = -(-self.size // workers)
+        ranges = attribute_ranges()
+        for offset in range(0, self.size, shard_size):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker,
+                                              args=(child, cases[offset:offset+shard_size],
+                                                    offset, engine, retrieval, probes, ranking, ranges))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def match_many(self, queries, count):
+        """Return the count best matches over all shards for each of
+        the queries, as lists of (similarity, index) tuples."""
+        for connection in self.connections:
+            connection.send((queries, count))
+        # Collect all results before raising any errors, to keep the
+        # connections in sync.
+        results = [connection.recv() for connection in self.connections]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        # Each shard result is ordered best first, with ties in index
+        # order, and the shards are contiguous. Merging on (negated
+        # similarity, index) thus gives the same order as matching
+        # the whole case base at once.
+        merged = []
+        for shard_results in zip(*results):
+            best = heapq.merge(*shard_results, key=lambda x: (-x[0], x[1]))
+            merged.append(list(islice(best, max(count, 0))))
+        return merged
+
+    def close(self):
+        """Stop all worker processes."""
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (EOFError, OSError):
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self.connections = []
+        self.processes = []
@@ -0,0 +1,542 @@
+## -*- coding: utf-8 -*-
+##
+## store.py
+##
+## Date:     16 October 2026
+## Copyright (c) 2026, the cbr-system contributors
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Columnar binary case store.
+
+The file starts with a magic string and the length of a JSON header,
+followed by the header itself and the column data. The header holds
+the number of cases, the attribute ranges and a description of each
+column. Columns are arrays of 32-bit little-endian integers, one per
+case, and are either:
+
+- number columns, holding the value of a numeric attribute directly,
+  or
+- dictionary columns, holding a code into a list of distinct values.
+
+Missing values are stored as -1. The distinct values of a dictionary
+column are stored after the column data, as an array of count+1
+32-bit offsets followed by the JSON encoded values, so value number i
+is the bytes from offset i to offset i+1.
+
+The store is opened with mmap, and the columns are used directly from
+the mapped file. Only the header is parsed when a store is opened, and
+the distinct values are decoded when first accessed, so opening a
+store takes the same time regardless of its size, and processes
+opening the same store share its pages.
+
+A store is never modified in place. update_store() writes a new
+version of the file and replaces the old one, so programs that have
+the old version open keep working on it until they reopen the
+store (see CaseStore.changed())."""
+
+__all__ = ['CaseStore', 'write_store', 'update_store', 'load_cases']
+
+import json, mmap, os, struct, sys
+from array import array
+
+import attribute_names
+from attributes import Numeric
+from case import CaseTable, TableColumn
+from ranges import attribute_range
+
+magic = b"CBRCASES"
+version = 2
+# Versions that can still be read; version 1 stores the distinct
+# values in the header.
+versions = (1, 2)
+_header_format = "<8sI"
+
+class NumberColumn(object):
+    """A numeric attribute stored as the plain values (-1 if
+    missing). Attribute objects are created when accessed."""
+
+    def __init__(self, attribute, numbers):
+        self.attribute = attribute
+        self.numbers = numbers
+
+    def get(self, index):
+        value = self.numbers[index]
+        if value < 0:
+            return None
+        return self.attribute.decode(value)
+
+    def has(self, index):
+        return self.numbers[index] >= 0
+
+    def slice(self, index):
+        return NumberColumn(self.attribute, self.numbers[index])
+
+    def find(self, attr):
+        """Index of the first case with an attribute equal to attr, or
+        -1 if there is none."""
+        if not isinstance(attr, self.attribute):
+            return -1
+        try:
+            return array('i', self.numbers).index(attr.encode())
+        except (ValueError, OverflowError, TypeError):
+            return -1
+
+    def table_column(self):
+        """TableColumn with the same values."""
+        values = []
+        codes = {}
+        integers = array('i')
+        for number in self.numbers:
+            if number < 0:
+                integers.append(-1)
+                continue
+            code = codes.get(number)
+            if code is None:
+                code = codes[number] = len(values)
+                values.append(self.attribute.decode(number))
+            integers.append(code)
+        column = TableColumn()
+        column.__setstate__((values, integers))
+        return column
+
+class DictionaryValues(object):
+    """The distinct values of a dictionary column of a case store, as
+    a read-only sequence of attributes. encoded(code) gives the stored
+    (JSON) value of a code, and each value is only decoded when it is
+    first accessed."""
+
+    def __init__(self, attribute, count, encoded):
+        self.attribute = attribute
+        self.count = count
+        self.encoded = encoded
+        self._decoded = {}
+
+    def __getitem__(self, code):
+        if isinstance(code, slice):
+            return [self[c] for c in range(*code.indices(self.count))]
+        if code < 0:
+            code += self.count
+        if not 0 <= code < self.count:
+            raise IndexError("value code out of range")
+        value = self._decoded.get(code)
+        if value is None:
+            value = self._decoded[code] = self.attribute.decode(self.encoded(code))
+        return value
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for code in range(self.count):
+            yield self[code]
+
+class CaseStore(CaseTable):
+    """A read-only CaseTable backed by a memory mapped case store
+    file. A store can be restricted to the cases start:stop, and is
+    pickled by reference to the file, so other processes map the same
+    file rather than receiving a copy of the cases. Slices of a store
+    share its mapping and decoded values."""
+
+    def __init__(self, filename, start=0, stop=None):
+        self.filename = filename
+        with open(filename, "rb") as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic,header_length = struct.unpack_from(_header_format, self._map)
+        if file_magic != magic:
+            raise ValueError("Not a case store: %s" % filename)
+        data_start = struct.calcsize(_header_format)
+        header = json.loads(self._map[data_start:data_start+header_length].decode("utf-8"))
+        if not header['version'] in versions:
+            raise ValueError("Unsupported case store version: %s" % header['version'])
+        data_start += header_length
+
+        self.header = header
+        self.generation = header.get('generation', 0)
+        self._stat = _file_id(filename)
+        self.ranges = dict([(k,tuple(v)) for (k,v) in list(header['ranges'].items())])
+        self._columns = {}
+        data = memoryview(self._map)
+        for description in header['columns']:
+            offset = data_start + description['offset']
+            integers = _integers(data[offset:offset+4*header['size']])
+            attribute = getattr(attribute_names, description['name'])
+            if description['kind'] == 'number':
+                column = NumberColumn(attribute, integers)
+            else:
+                column = TableColumn()
+                column.__setstate__((_dictionary_values(attribute, description, data, data_start),
+                                     integers))
+            self._columns[description['name']] = column
+        self._restrict(start, stop)
+
+    def _restrict(self, start, stop):
+        """Restrict the cases to start:stop of the whole store."""
+        self.start,self.stop,step = slice(start, stop).indices(self.header['size'])
+        self.size = max(self.stop-self.start, 0)
+        if self.start == 0 and self.stop == self.header['size']:
+            self.columns = self._columns
+        else:
+            index = slice(self.start, max(self.stop, self.start))
+            self.columns = dict([(name, column.slice(index))
+                                 for (name, column) in list(self._columns.items())])
+
+    def append(self, case):
+        raise TypeError("Case stores are read-only.")
+
+    def extend(self, table):
+        raise TypeError("Case stores are read-only.")
+
+    def replace(self, index, case):
+        raise TypeError("Case stores are read-only.")
+
+    def remove(self, index):
+        raise TypeError("Case stores are read-only.")
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) and index.step in (None, 1):
+            start,stop,step = index.indices(self.size)
+            store = CaseStore.__new__(CaseStore)
+            store.__dict__.update(self.__dict__)
+            store._restrict(self.start+start, self.start+max(start, stop))
+            return store
+        return CaseTable.__getitem__(self, index)
+
+    def copy(self):
+        """An in-memory CaseTable with the cases of the store, which
+        can be modified."""
+        table = CaseTable()
+        table.size = self.size
+        for name,column in list(self.columns.items()):
+            if isinstance(column, NumberColumn):
+                table.columns[name] = column.table_column()
+            else:
+                table.columns[name] = column.copy()
+        return table
+
+    def changed(self):
+        """Whether the store file has been replaced since this store
+        was opened."""
+        return _file_id(self.filename) != self._stat
+
+    def reopen(self):
+        """Open the current version of the store file (with the same
+        start and stop)."""
+        return CaseStore(self.filename, self.start, self.stop if self.stop < self.header['size'] else None)
+
+    def __reduce__(self):
+        return (CaseStore, (self.filename, self.start, self.stop))
+
+    def __repr__(self):
+        return "<CaseStore: %s, %d cases>" % (self.filename, self.size)
+
+def _dictionary_values(attribute, description, data, data_start):
+    """The distinct values of a dictionary column, described by
+    description, of the store mapped in data."""
+    if 'values' in description:
+        # Version 1: the values are in the header.
+        values = description['values']
+        return DictionaryValues(attribute, len(values), values.__getitem__)
+    count = description['values_count']
+    start = data_start + description['values_offset']
+    offsets = _integers(data[start:start+4*(count+1)])
+    start += 4*(count+1)
+    def encoded(code):
+        return json.loads(bytes(data[start+offsets[code]:start+offsets[code+1]]).decode("utf-8"))
+    return DictionaryValues(attribute, count, encoded)
+
+def _encoded_values(values):
+    """The encoded values of a dictionary column, without decoding
+    them into attributes."""
+    if isinstance(values, DictionaryValues):
+        return [values.encoded(code) for code in range(len(values))]
+    return [v.encode() for v in values]
+
+def _integers(data):
+    """View the bytes in data as 32-bit little-endian integers. On
+    big-endian machines, the data has to be copied."""
+    if sys.byteorder == 'little':
+        return data.cast('i')
+    integers = array('i', data.tobytes())
+    integers.byteswap()
+    return integers
+
+def _file_id(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _encode_columns(cases):
+    """Encode the columns of a CaseTable for storing. Returns a list
+    of [name, kind, values, integers] lists, where values are the
+    encoded distinct values of a dictionary column (None for number
+    columns)."""
+    columns = []
+    for name,column in list(cases.columns.items()):
+        if isinstance(column, NumberColumn):
+            columns.append([name, 'number', None, array('i', column.numbers)])
+            continue
+        values = _encoded_values(column.values)
+        if all(isinstance(v, Numeric) for v in column.values) and \
+                all(0 <= v < 2**31 for v in values):
+            columns.append([name, 'number', None,
+                            array('i', [values[c] if c >= 0 else -1 for c in column.codes])])
+        else:
+            columns.append([name, 'dictionary', values, array('i', column.codes)])
+    return columns
+
+def _write_columns(filename, size, ranges, columns, generation=0):
+    descriptions = []
+    offset = 0
+    for name,kind,values,integers in columns:
+        descriptions.append({'name': name, 'offset': offset, 'kind': kind})
+        offset += 4*len(integers)
+    sections = []
+    for description,(name,kind,values,integers) in zip(descriptions, columns):
+        if kind != 'dictionary':
+            continue
+        encoded = [json.dumps(v).encode("utf-8") for v in values]
+        offsets = array('i', [0])
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+        section = b"".join(encoded)
+        # Pad the section so the next one is aligned.
+        section += b" " * (-(4*len(offsets)+len(section)) % 8)
+        description['values_offset'] = offset
+        description['values_count'] = len(values)
+        sections.append((offsets, section))
+        offset += 4*len(offsets) + len(section)
+
+    header = json.dumps({'version': version,
+                         'generation': generation,
+                         'size': size,
+                         'ranges': ranges,
+                         'columns': descriptions}).encode("utf-8")
+    # Pad the header so the column data is aligned.
+    header += b" " * (-(struct.calcsize(_header_format)+len(header)) % 8)
+    with open(filename, "wb") as fp:
+        fp.write(struct.pack(_header_format, magic, len(header)))
+        fp.write(header)
+        for name,kind,values,integers in columns:
+            fp.write(_little_endian(integers))
+        for offsets,section in sections:
+            fp.write(_little_endian(offsets))
+            fp.write(section)
+
+def _little_endian(integers):
+    """The bytes of an array of integers, in little-endian order."""
+    if sys.byteorder != 'little':
+        integers = array('i', integers)
+        integers.byteswap()
+    return integers.tobytes()
+
+def load_cases(store_filename="cases.store", case_filename="cases.pickle"):
+    """Load the case base from a case store, or if there is none, from
+    a pickled case base. Returns (cases, ranges), or None if neither
+    file exists. The distance table stored next to the file (see
+    place.DistanceTable) is loaded along with it."""
+    import place
+    if os.path.exists(store_filename):
+        place.load_distance_table(place.distance_table_path(store_filename))
+        # The store is memory mapped, so only the header is read here.
+        cases = CaseStore(store_filename)
+        return cases, cases.ranges
+    if os.path.exists(case_filename):
+        import pickle
+        place.load_distance_table(place.distance_table_path(case_filename))
+        with open(case_filename, "rb") as fp:
+            ranges,cases = pickle.load(fp)
+        # Older case files contain a list of Case objects.
+        if not isinstance(cases, CaseTable):
+            cases = CaseTable(cases)
+        return cases, ranges
+    return None
+
+def write_store(filename, cases, ranges):
+    """Write cases (a CaseTable or a list of cases) and the attribute
+    ranges to a case store file."""
+    if not isinstance(cases, CaseTable):
+        cases = CaseTable(cases)
+    _write_columns(filename, len(cases), ranges, _encode_columns(cases))
+
+def _value_key(value):
+    return json.dumps(value, sort_keys=True)
+
+def update_store(filename, cases=[], delete=[], replace=True, key='JourneyCode'):
+    """Update a case store with new cases, identified by their key
+    attribute.
+
+    New cases are added to the end of the store. If a case with the
+    same key is already in the store, it is replaced in place if
+    replace is true, and otherwise a ValueError is raised. Cases whose
+    key is in delete are removed. Afterwards, the stored attribute
+    ranges are recomputed for the resulting cases, and the new store
+    is written to a temporary file, which then replaces the old one.
+
+    Returns the number of added, replaced and deleted cases, and a
+    list of the keys in delete that were not found."""
+    store = CaseStore(filename)
+    size = len(store)
+    ranges = dict(store.ranges)
+    generation = store.generation
+    columns = []
+    for description in store.header['columns']:
+        column = store.columns[description['name']]
+        if description['kind'] == 'number':
+            columns.append([description['name'], 'number', None, array('i', column.numbers)])
+        else:
+            columns.append([description['name'], 'dictionary',
+                            _encoded_values(column.values), array('i', column.codes)])
+
+    by_name = dict([(c[0], c) for c in columns])
+    if not key in by_name:
+        raise ValueError("The case store has no %s attribute." % key)
+    rows = {}
+    for row,value in enumerate(_column_values(by_name[key])):
+        if value is not None:
+            rows.setdefault(_value_key(value), row)
+
+    if not isinstance(cases, CaseTable):
+        cases = CaseTable(cases)
+    new_columns = _encode_columns(cases)
+    new_values = dict([(c[0], _column_values(c)) for c in new_columns])
+    if not key in new_values and len(cases):
+        raise ValueError("Cases to add must have a %s attribute." % key)
+    for name,kind,values,integers in new_columns:
+        if not name in by_name:
+            column = [name, 'number' if kind == 'number' else 'dictionary',
+                      None if kind == 'number' else [], array('i', [-1])*size]
+            columns.append(column)
+            by_name[name] = column
+    indexes = dict([(c[0], dict([(_value_key(v), i) for (i,v) in enumerate(c[2])]))
+                    for c in columns if c[1] == 'dictionary'])
+
+    added = replaced = 0
+    for i in range(len(cases)):
+        value = new_values[key][i]
+        if value is None:
+            raise ValueError("Cases to add must have a %s attribute." % key)
+        row = rows.get(_value_key(value))
+        if row is None:
+            row = rows[_value_key(value)] = size
+            size += 1
+            added += 1
+            for column in columns:
+                column[3].append(-1)
+        elif not replace:
+            raise ValueError("A case with %s %s already exists." % (key, value))
+        else:
+            replaced += 1
+        for column in columns:
+            name = column[0]
+            value = new_values[name][i] if name in new_values else None
+            if value is None:
+                column[3][row] = -1
+                continue
+            if column[1] == 'number' and not (isinstance(value, int) and 0 <= value < 2**31):
+                _to_dictionary(column)
+                indexes[name] = dict([(_value_key(v), i) for (i,v) in enumerate(column[2])])
+            if column[1] == 'number':
+                column[3][row] = value
+            else:
+                code = indexes[name].setdefault(_value_key(value), len(column[2]))
+                if code == len(column[2]):
+                    column[2].append(value)
+                column[3][row] = code
+
+    delete_rows = set()
+    missing = []
+    for value in delete:
+        row = rows.get(_value_key(value))
+        if row is None:
+            missing.append(value)
+        else:
+            delete_rows.add(row)
+    if delete_rows:
+        keep = [i for i in range(size) if not i in delete_rows]
+        for column in columns:
+            integers = column[3]
+            column[3] = array('i', [integers[i] for i in keep])
+        size = len(keep)
+    for column in columns:
+        if column[1] == 'dictionary':
+            _compact(column)
+
+    for name in ranges:
+        if name in by_name:
+            ranges[name] = _column_range(by_name[name]) or ranges[name]
+
+    temp_filename = filename + ".tmp"
+    _write_columns(temp_filename, size, ranges, columns, generation+1)
+    os.replace(temp_filename, filename)
+    return added, replaced, len(delete_rows), missing
+
+def _column_values(column):
+    """The encoded value of each row of a column (None if missing)."""
+    name,kind,values,integers = column
+    if kind == 'number':
+        return [v if v >= 0 else None for v in integers]
+    return [values[c] if c >= 0 else None for c in integers]
+
+def _to_dictionary(column):
+    values = []
+    codes = {}
+    integers = column[3]
+    for i,value in enumerate(integers):
+        if value >= 0:
+            integers[i] = codes.setdefault(value, len(values))
+            if integers[i] == len(values):
+                values.append(value)
+    column[1] = 'dictionary'
+    column[2] = values
+
+def _compact(column):
+    """Remove the values of a dictionary column that are not used by
+    any case."""
+    name,kind,values,integers = column
+    used = sorted(set(integers) - set([-1]))
+    if len(used) == len(values):
+        return
+    codes = dict([(c, i) for (i,c) in enumerate(used)])
+    column[2] = [values[c] for c in used]
+    column[3] = array('i', [codes[c] if c >= 0 else -1 for c in integers])
+
+def _column_range(column):
+    """Range of the values of a column that are used by any case, or
+    None if it has no values."""
+    name,kind,values,integers = column
+    if kind == 'number':
+        used = sorted(set(integers) - set([-1]))
+    else:
+        used = [values[c] for c in sorted(set(integers) - set([-1]))]
+    attribute = getattr(attribute_names, name)
+    return attribute_range(name, [attribute.decode(v) for v in used])
+
+
+if __name__ == "__main__":
+    try:
+        import pickle
+        if len(sys.argv) < 3:
+            print("Usage: %s <cases.pickle> <cases.store>." % sys.argv[0])
+            print("Converts a pickled case base to a case store.")
+            sys.exit(1)
+        with open(sys.argv[1], "rb") as fp:
+            ranges,cases = pickle.load(fp)
+        write_store(sys.argv[2], cases, ranges)
+        print("Wrote %d cases to %s." % (len(cases), sys.argv[2]))
+    except RuntimeError as e:
+        sys.stderr.write("Fatal error occurred: %s\n" % e)
+        sys.exit(1)
@@ -20,20 +20,72 @@
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 class Tree(object):
+    """A tree of named nodes with values.
+
+    Nodes are indexed by name when they are added, and each node
+    stores its depth and a table of its 2^i'th ancestors (binary
+    lifting). Finding a node is then a dictionary lookup, and the
+    nearest common ancestor of two nodes is found in time logarithmic
+    in the depth of the tree."""
+
     def __init__(self, tree):
+        self.index = {}
         self.root = Node(tree[0], tree[1])
+        self.add_node(self.root)
         self.add_level(self.root, tree[2])
 
     def add_level(self, parent, values):
         for value in values:
             node = parent.add_chield(value[0], value[1])
+            self.add_node(node)
             self.add_level(node, value[2])
 
+    def add_node(self, node):
+        """Add a node to the index, and compute its ancestor table.
+        If several nodes have the same name, the first one added (in
+        depth-first order) is found by name."""
+        if not node.name in self.index:
+            self.index[node.name] = node
+        node.ancestors = []
+        if node.parent is None:
+            node.depth = 0
+        else:
+            node.depth = node.parent.depth + 1
+            ancestor = node.parent
+            while ancestor is not None:
+                node.ancestors.append(ancestor)
+                i = len(node.ancestors)-1
+                if i < len(ancestor.ancestors):
+                    ancestor = ancestor.ancestors[i]
+                else:
+                    ancestor = None
+
+    def names(self):
+        """All node names in the tree, in depth-first order."""
+        return list(self.index.keys())
+
+    def __contains__(self, name):
+        return name in self.index
+
     def find_path(self, name, root=None):
+        """Find the path from the root to a node with a given name"""
+        if root is not None and root is not self.root:
+            return self._search_path(name, root)
+        return self._node_path(self.index.get(name))
+
+    def _node_path(self, node):
+        """Path from the root to node, following parent links"""
+        if node is None:
+            return None
+        path = []
+        while node is not None:
+            path.append(node)
+            node = node.parent
+        path.reverse()
+        return path
+
+    def _search_path(self, name, root):
         """Depth-first search to find the path to a node with a given name"""
-        if root is None:
-            root = self.root
-
         if root.name == name:
             return [root]
 
@@ -41,41 +93,61 @@ class Tree(object):
             return None
 
         for child in root.children:
-            found = self.find_path(name, child)
+            found = self._search_path(name, child)
             if found is not None:
                 return [root]+found
 
-    def find_common_path(self, names):
-        """Find common path between a set of nodes."""
-        paths = []
+    def common_ancestor(self, names):
+        """Find the nearest common ancestor node of a set of nodes.
+        Returns None if any of the names are not in the tree."""
+        common = None
         for name in names:
-            path = self.find_path(name)
-            if path is None:
+            node = self.index.get(name)
+            if node is None:
                 return None
-            paths.append(path)
-        common_path = []
-        for i in range(min([len(p) for p in paths])):
-            steps = [p[i] for p in paths]
-            value = steps[0]
-            for s in steps:
-                if s != value:
-                    return common_path
-            common_path.append(value)
-        return common_path
+            if common is None:
+                common = node
+            else:
+                common = self._lowest_common_ancestor(common, node)
+        return common
+
+    def _lowest_common_ancestor(self, a, b):
+        if a.depth < b.depth:
+            a,b = b,a
+        # Lift a to the depth of b, then lift both as far as possible
+        # while they are still different.
+        difference = a.depth - b.depth
+        i = 0
+        while difference:
+            if difference & 1:
+                a = a.ancestors[i]
+            difference >>= 1
+            i += 1
+        if a is b:
+            return a
+        for i in range(len(a.ancestors)-1, -1, -1):
+            if i < len(a.ancestors) and a.ancestors[i] is not b.ancestors[i]:
+                a = a.ancestors[i]
+                b = b.ancestors[i]
+        return a.parent
+
+    def find_common_path(self, names):
+        """Find common path between a set of nodes."""
+        return self._node_path(self.common_ancestor(names))
 
     def find_value(self, name):
         """Find the value for a name in the tree"""
-        path = self.find_path(name)
-        if path is None:
+        node = self.index.get(name)
+        if node is None:
             return None
-        return path[-1].value
+        return node.value
 
     def find_common_value(self, names):
         """Find the value of the nearest common ancestor of a set of nodes"""
-        path = self.find_common_path(names)
-        if path is None:
+        node = self.common_ancestor(names)
+        if node is None:
             return None
-        return path[-1].value
+        return node.value
 
 
     def __repr__(self):
@@ -95,7 +167,7 @@ class Node(object):
         return n
 
     def __repr__(self):
-        return "<Node: %s, %s>" % (self.name, self.value, ", ".join(map(repr,self.children)))
+        return "<Node: %s, %s [%s]>" % (self.name, self.value, ", ".join(map(repr,self.children)))
 
 
 if __name__ == "__main__":
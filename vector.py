@@ -0,0 +1,788 @@
+## -*- coding: utf-8 -*-
+##
+## vector.py
+##
+## Date:     16 October 2026
+## Copyright (c) 2026, the cbr-system contributors
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['CaseColumns', 'ClusterIndex', 'best_indices']
+
+import numpy
+
+from attributes import Numeric, ExactMatch, LinearMatch, LessIsPerfect, MoreIsPerfect, \
+    NumericAdapt, LinearAdjust
+from case import CaseTable
+from kdtree import CaseTree
+from store import NumberColumn
+
+class Column(object):
+    """A single attribute of the case base, stored as a column.
+
+    Every distinct attribute value is stored once in values, and codes
+    holds the index into values for each case (or -1 if the case does
+    not have the attribute). For numeric attributes, numbers holds the
+    value of each case, either as a float (NaN if missing) or, for
+    number columns of a case store, as the stored integer (-1 if
+    missing)."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.values = []
+        self.codes = numpy.empty(size, dtype=numpy.int32)
+        self.codes.fill(-1)
+        self.numbers = None
+        self.missing = None
+        self.attribute = None
+        self._index = {}
+
+    @classmethod
+    def from_table(cls, name, table_column):
+        """Column reusing the encoding of a CaseTable column. The
+        columns of a memory mapped case store are used without
+        copying them."""
+        column = cls(name, 0)
+        if isinstance(table_column, NumberColumn):
+            column.numbers = _integers(table_column.numbers)
+            column.attribute = table_column.attribute
+            column.codes = None
+        else:
+            column.values = list(table_column.values)
+            column.codes = _integers(table_column.codes)
+        return column
+
+    def add(self, i, attr):
+        try:
+            key = attr.value
+            code = self._index.get(key)
+        except TypeError:
+            # Unhashable value; store it without sharing.
+            key = code = None
+        if code is None:
+            code = len(self.values)
+            self.values.append(attr)
+            if key is not None:
+                self._index[key] = code
+        self.codes[i] = code
+
+    def finish(self):
+        """Build the numeric column if all values are numeric, and
+        the mask of missing values."""
+        if self.numbers is None:
+            if self.values and all(isinstance(v, Numeric) for v in self.values):
+                table = numpy.array([v.value for v in self.values] + [numpy.nan],
+                                    dtype=numpy.float64)
+                self.numbers = table[self.codes]
+            self.missing = self.codes < 0
+        else:
+            self.missing = self.numbers < 0
+        self._index = None
+
+    def _encode_numbers(self):
+        """Build values and codes for a number column, which only
+        stores the numbers themselves."""
+        if self.codes is None:
+            distinct,codes = numpy.unique(self.numbers, return_inverse=True)
+            self.values = [self.attribute.decode(int(v)) for v in distinct]
+            codes = codes.reshape(-1).astype(numpy.int32)
+            codes[self.missing] = -1
+            self.codes = codes
+
+    def take(self, indices):
+        """Column of the cases with the given indices (a list). Only
+        the values used by those cases are kept."""
+        column = Column(self.name, 0)
+        column.attribute = self.attribute
+        column.missing = self.missing[indices]
+        if self.numbers is not None:
+            column.numbers = self.numbers[indices]
+        if self.codes is not None:
+            codes = self.codes[indices]
+            used = numpy.unique(codes[codes >= 0])
+            column.values = [self.values[c] for c in used]
+            column.codes = numpy.searchsorted(used, codes).astype(numpy.int32)
+            column.codes[column.missing] = -1
+        else:
+            column.codes = None
+        column._index = None
+        return column
+
+    def with_numbers(self, numbers):
+        """Copy of the column with the given numbers (floats, NaN if
+        missing) instead of its own. Only the numbers of the copy can
+        be compared to a query."""
+        column = Column(self.name, 0)
+        column.attribute = self.attribute
+        column.values = self.values
+        column.codes = self.codes
+        column.numbers = numbers
+        column.missing = self.missing
+        column._index = None
+        return column
+
+    def _size(self):
+        return len(self.codes if self.codes is not None else self.numbers)
+
+    def _writable(self, size):
+        """Prepare the column for changes, with room for size cases.
+
+        Number columns of a case store are given codes, and their
+        numbers are converted to floats. The arrays are made views of
+        buffers that grow by doubling, so appending a case takes
+        amortised constant time."""
+        if self._index is None:
+            self._encode_numbers()
+            if self.numbers is not None and self.numbers.dtype != numpy.float64:
+                numbers = self.numbers.astype(numpy.float64)
+                numbers[self.missing] = numpy.nan
+                self.numbers = numbers
+            self._index = {}
+            for code,attr in enumerate(self.values):
+                try:
+                    self._index.setdefault(attr.value, code)
+                except TypeError:
+                    pass
+            self._buffers = {}
+        for name in ('codes', 'numbers', 'missing'):
+            array = getattr(self, name)
+            if array is None:
+                continue
+            buffer = self._buffers.get(name)
+            if buffer is None or len(buffer) < size:
+                buffer = numpy.empty(max(size, 2*len(array)), dtype=array.dtype)
+                buffer[:len(array)] = array
+                self._buffers[name] = buffer
+            setattr(self, name, buffer[:size])
+
+    def set(self, i, attr):
+        """Set the attribute of case number i (None if the case does
+        not have the attribute)."""
+        self._writable(self._size())
+        if attr is None:
+            self.codes[i] = -1
+        else:
+            self.add(i, attr)
+        self.missing[i] = attr is None
+        if self.numbers is not None:
+            if attr is None:
+                self.numbers[i] = numpy.nan
+            elif isinstance(attr, Numeric):
+                self.numbers[i] = attr.value
+            else:
+                # The column is no longer numeric.
+                self.numbers = None
+                del self._buffers['numbers']
+
+    def append(self, attr):
+        """Add a case with attribute attr (or None) to the end of the
+        column."""
+        size = self._size()
+        self._writable(size+1)
+        self.set(size, attr)
+
+    def remove(self, i):
+        """Remove case number i from the column."""
+        size = self._size()
+        self._writable(size)
+        for name in ('codes', 'numbers', 'missing'):
+            array = getattr(self, name)
+            if array is not None:
+                array[i:-1] = array[i+1:]
+                setattr(self, name, array[:-1])
+
+    def similarity(self, attr):
+        """Similarity of query attribute attr to every case in the
+        column. Cases missing the attribute get a similarity of 0."""
+        method = type(attr).similarity
+        if self.numbers is not None and method in _numeric_methods:
+            value = float(attr.value)
+            if method is ExactMatch.similarity:
+                return numpy.where(self.numbers == value, attr.weight, 0.0)
+            sim = _linear_similarity(attr, self.numbers, value)
+            if method is LessIsPerfect.similarity:
+                sim = numpy.where(self.numbers < value, attr.weight, sim)
+            elif method is MoreIsPerfect.similarity:
+                sim = numpy.where(self.numbers > value, attr.weight, sim)
+            sim[self.missing] = 0.0
+            return sim
+
+        self._encode_numbers()
+        return self._table(attr)[self.codes]
+
+    def similarity_many(self, attrs):
+        """Similarity of each of the query attributes attrs (which
+        must all be of the same class) to every case in the column, as
+        an (attributes x cases) array."""
+        method = type(attrs[0]).similarity
+        if self.numbers is not None and method in _numeric_methods:
+            values = numpy.array([attr.value for attr in attrs], dtype=numpy.float64)[:,numpy.newaxis]
+            weights = numpy.array([attr.weight for attr in attrs], dtype=numpy.float64)[:,numpy.newaxis]
+            if method is ExactMatch.similarity:
+                return numpy.where(self.numbers == values, weights, 0.0)
+            sim = _linear_similarity(attrs[0], self.numbers, values, weights)
+            if method is LessIsPerfect.similarity:
+                sim = numpy.where(self.numbers < values, weights, sim)
+            elif method is MoreIsPerfect.similarity:
+                sim = numpy.where(self.numbers > values, weights, sim)
+            sim[:,self.missing] = 0.0
+            return sim
+
+        # Compute the lookup table once for each distinct query value.
+        self._encode_numbers()
+        tables = {}
+        rows = []
+        for attr in attrs:
+            try:
+                key = (attr.value, attr.weight)
+                if not key in tables:
+                    tables[key] = self._table(attr)
+                rows.append(tables[key])
+            except TypeError:
+                rows.append(self._table(attr))
+        return numpy.array(rows)[:,self.codes]
+
+    def _table(self, attr):
+        """Similarity of attr to each distinct value in the column.
+        The extra 0.0 at the end of the table is picked up by the -1
+        code of missing values."""
+        return numpy.array([attr.similarity(v) for v in self.values] + [0.0],
+                           dtype=numpy.float64)
+
+def _integers(data):
+    """Integer array for the codes or numbers of a table column. A
+    memoryview (of a memory mapped store) is used as is, while arrays
+    are copied, since they can still grow."""
+    if isinstance(data, memoryview):
+        return numpy.frombuffer(data, dtype=numpy.int32)
+    return numpy.array(data, dtype=numpy.int32)
+
+_numeric_methods = (LinearMatch.similarity,
+                    LessIsPerfect.similarity,
+                    MoreIsPerfect.similarity,
+                    ExactMatch.similarity)
+
+def _linear_similarity(attr, numbers, value=None, weight=None):
+    """Array version of LinearMatch.similarity, performing the same
+    floating point operations in the same order as Attribute.scale.
+
+    The scaling parameters are taken from attr. The query value and
+    weight default to those of attr, but can be given as arrays to
+    compare several query values at once."""
+    if value is None:
+        value = float(attr.value)
+    if weight is None:
+        weight = attr.weight
+    diff = numpy.abs(value - numbers)
+    if hasattr(attr, '_range'):
+        min_val = numpy.minimum(numpy.minimum(attr._range[0], value), numbers)
+        max_val = numpy.maximum(numpy.maximum(attr._range[1], value), numbers)
+        scaled = diff/(max_val-min_val)
+    elif hasattr(attr, '_scale'):
+        scaled = diff/attr._scale
+    else:
+        scaled = diff
+    return weight*(1.0-scaled)
+
+def _score_key(attr):
+    """Key identifying the similarities of a query attribute to the
+    case base, or None if it has an unhashable value. The range is
+    part of the key, since the similarities depend on it."""
+    try:
+        value = attr._intern_key()
+        hash(value)
+    except TypeError:
+        return None
+    return (attr.name, type(attr), value, attr.weight, tuple(getattr(attr, '_range', ())))
+
+class CaseColumns(object):
+    """Columnar encoding of a case base, used to compute the
+    similarity of a query to all cases at once with array operations.
+
+    The result of similarity() is identical to mapping
+    Case.similarity over the cases.
+
+    The similarities of each attribute of the last query are kept, so
+    when a query is refined one attribute at a time, only the
+    similarities of the changed attribute are computed. The kept
+    similarities are summed again rather than updated by subtracting
+    the old similarities, since that would not round the same way."""
+
+    # Maximum number of elements in the similarity matrix when
+    # matching many queries at once.
+    block_size = 1 << 22
+
+    def __init__(self, cases):
+        self.cases = cases
+        self.size = len(cases)
+        self.columns = {}
+        self._scores = {}
+        if isinstance(cases, CaseTable):
+            # The case table is already encoded by column.
+            for name,table_column in list(cases.columns.items()):
+                self.columns[name] = Column.from_table(name, table_column)
+        else:
+            for i,case in enumerate(cases):
+                for name,attr in case.items():
+                    if not name in self.columns:
+                        self.columns[name] = Column(name, self.size)
+                    self.columns[name].add(i, attr)
+        for column in self.columns.values():
+            column.finish()
+
+    def take(self, indices, names=None):
+        """Columns of the cases with the given indices (a list). If
+        names is given, only the columns of these attributes are
+        kept."""
+        columns = CaseColumns([])
+        columns.size = len(indices)
+        for name,column in list(self.columns.items()):
+            if names is None or name in names:
+                columns.columns[name] = column.take(indices)
+        return columns
+
+    def append(self, case):
+        """Add a case to the end of the columns."""
+        self._scores = {}
+        self._add_columns(case)
+        for name,column in list(self.columns.items()):
+            column.append(case[name] if name in case else None)
+        self.size += 1
+
+    def replace(self, index, case):
+        """Replace case number index with case."""
+        self._scores = {}
+        self._add_columns(case)
+        for name,column in list(self.columns.items()):
+            column.set(index, case[name] if name in case else None)
+
+    def remove(self, index):
+        """Remove case number index."""
+        self._scores = {}
+        for column in list(self.columns.values()):
+            column.remove(index)
+        self.size -= 1
+
+    def _add_columns(self, case):
+        for name in case:
+            if not name in self.columns:
+                column = Column(name, self.size)
+                column.finish()
+                self.columns[name] = column
+
+    def similarity(self, query):
+        """Compute the similarity of query to every case. Returns an
+        array of normalised similarities in case base order."""
+        total_weight = 0.0
+        total_similarity = numpy.zeros(self.size, dtype=numpy.float64)
+        scores = {}
+        for attr in list(query.values()):
+            if attr.matching:
+                if attr.name in self.columns:
+                    key = _score_key(attr)
+                    sim = self._scores.get(key)
+                    if sim is None:
+                        sim = self.columns[attr.name].similarity(attr)
+                    if key is not None:
+                        scores[key] = sim
+                    total_similarity += sim
+                # Cases without the attribute count as a 0 match, but
+                # the weight is still added.
+                total_weight += attr.weight
+        self._scores = scores
+        if total_weight == 0.0:
+            return numpy.zeros(self.size, dtype=numpy.float64)
+        return total_similarity / total_weight
+
+    def similarity_many(self, queries):
+        """Compute the similarity of each of the queries to every
+        case. Returns a (queries x cases) array of normalised
+        similarities.
+
+        The attributes are compared one query attribute position at a
+        time, grouping the queries that have the same attribute at
+        that position, so each group is compared to the case base in
+        one sweep. Going by position keeps the order in which the
+        similarities of each query are summed the same as in
+        Case.similarity(), so the results are identical."""
+        attrs = [[a for a in list(q.values()) if a.matching] for q in queries]
+        total_weight = numpy.zeros(len(queries), dtype=numpy.float64)
+        total_similarity = numpy.zeros((len(queries), self.size), dtype=numpy.float64)
+        for position in range(max([len(a) for a in attrs] + [0])):
+            groups = {}
+            for i,query_attrs in enumerate(attrs):
+                if position < len(query_attrs):
+                    attr = query_attrs[position]
+                    groups.setdefault((attr.name, type(attr)), []).append(i)
+            for (name,cls),rows in list(groups.items()):
+                group = [attrs[i][position] for i in rows]
+                if name in self.columns:
+                    total_similarity[rows] += self.columns[name].similarity_many(group)
+                total_weight[rows] += [attr.weight for attr in group]
+        # Queries without any matching attributes get a similarity of
+        # 0 for all cases, as in Case.similarity().
+        total_weight[total_weight == 0.0] = numpy.inf
+        return total_similarity / total_weight[:,numpy.newaxis]
+
+    def adapt(self, query):
+        """Adapt every case to query, as Case.adapt() does. Returns
+        the similarities of the adapted cases to query, and a mask of
+        the cases that were changed by the adaptation (that have an
+        adaptable value differing from the query, and no adjusted
+        value below 1, which Numeric does not allow). Returns None if
+        the adaptation cannot be done with array operations."""
+        adapted = self.adapted(query)
+        if adapted is None:
+            return None
+        columns,changed,valid = adapted
+        return columns.similarity(query), changed & valid
+
+    def adapted_similarity(self, query):
+        """Similarity of query to every case after adapting the case
+        to it, or to the case itself if it cannot be adapted. Returns
+        None if the adaptation cannot be done with array operations.
+
+        The similarities of the attributes that are not changed by
+        the adaptation are shared with the plain similarity."""
+        similarities = self.similarity(query)
+        adapted = self.adapted(query)
+        if adapted is None:
+            return None
+        columns,changed,valid = adapted
+        return numpy.where(valid, columns.similarity(query), similarities)
+
+    def adapted(self, query):
+        """The cases adapted to query (see Case.adapt()), as a new
+        CaseColumns sharing the columns that do not change. Returns
+        the columns, a mask of the cases with an adaptable value
+        differing from the query, and a mask of the cases that can be
+        adapted, or None if the adaptation cannot be done with array
+        operations.
+
+        The adaptation factors are multiplied in column order; this
+        is the attribute order of the cases, as long as all cases have
+        their attributes in the same order (as in a case table)."""
+        factors = numpy.ones(self.size, dtype=numpy.float64)
+        changed = numpy.zeros(self.size, dtype=bool)
+        valid = numpy.ones(self.size, dtype=bool)
+        columns = dict(self.columns)
+        for name,column in list(self.columns.items()):
+            cls = self._attribute_class(column)
+            if cls is None or not cls._adaptable or not name in query:
+                continue
+            if column.numbers is None or cls.adapt_distance is not NumericAdapt.adapt_distance \
+                    or not type(query[name]).similarity in _numeric_methods:
+                return None
+            numbers = self._floats(column)
+            value = float(query[name].value)
+            present = ~column.missing
+            factors *= numpy.where(present, value/numbers, 1.0)
+            changed |= present & (numbers != value)
+            columns[name] = column.with_numbers(numpy.where(present, value, numpy.nan))
+        for name,column in list(self.columns.items()):
+            cls = self._attribute_class(column)
+            if cls is None or not cls._adjustable or columns[name] is not column:
+                continue
+            if column.numbers is None or cls.adjusted is not LinearAdjust.adjusted \
+                    or not issubclass(cls, Numeric) \
+                    or (name in query and not type(query[name]).similarity in _numeric_methods):
+                return None
+            # int() truncates the adjusted value, like Numeric does.
+            numbers = numpy.trunc(self._floats(column)*factors)
+            present = ~column.missing
+            valid &= ~present | (numbers >= 1)
+            columns[name] = column.with_numbers(numpy.where(present, numbers, numpy.nan))
+        result = CaseColumns([])
+        result.size = self.size
+        result.columns = columns
+        result._scores = dict([(key, sim) for (key, sim) in list(self._scores.items())
+                               if columns[key[0]] is self.columns[key[0]]])
+        return result, changed, valid
+
+    def _attribute_class(self, column):
+        if column.attribute is not None:
+            return column.attribute
+        if column.values:
+            return type(column.values[0])
+        return None
+
+    def _floats(self, column):
+        """The numbers of a column as floats, with NaN for missing
+        values."""
+        numbers = column.numbers.astype(numpy.float64)
+        numbers[column.missing] = numpy.nan
+        return numbers
+
+    def match(self, query, count, partial=False):
+        """Return the count best matches as (similarity, index)
+        tuples, ordered the same way as Matcher.match()."""
+        similarities = self.similarity(query)
+        order = best_indices(similarities, count, partial)
+        return [(float(similarities[i]), int(i)) for i in order]
+
+    def match_many(self, queries, count, partial=False):
+        """Return the result of match() for each of the queries.
+
+        Queries are processed in blocks, keeping the similarity matrix
+        of each block below block_size elements."""
+        results = []
+        block = max(1, self.block_size // max(self.size, 1))
+        for start in range(0, len(queries), block):
+            similarities = self.similarity_many(queries[start:start+block])
+            for row in similarities:
+                order = best_indices(row, count, partial)
+                results.append([(float(row[i]), int(i)) for i in order])
+        return results
+
+class ClusterIndex(object):
+    """Inverted file index of the case base, used for approximate
+    retrieval.
+
+    The cases are placed in the space of the KD-tree (see
+    kdtree.CaseTree.case_axes()), where distances along the axes are
+    comparable to similarity differences, with an extra axis for each
+    value of the attributes with at most max_categories values (scaled
+    so that two different values are the weight of the attribute
+    apart), and split into clusters by k-means. A query is only
+    compared to the cases of the probes clusters with the centroids
+    nearest to it (on the axes of the attributes it has), so some of
+    the best matches may be missed. The cases of these clusters are
+    taken out of the columns, and compared in one go with
+    CaseColumns.similarity().
+
+    The clusters are trained on a sample of at most sample_factor
+    cases per cluster. Cases that are added or replaced later are put
+    in the cluster with the nearest centroid; the centroids are not
+    moved."""
+
+    # Number of k-means iterations.
+    iterations = 10
+
+    # Maximum number of distinct values of an attribute with an axis
+    # for each value.
+    max_categories = 16
+
+    # Maximum number of training cases per cluster.
+    sample_factor = 64
+
+    # Maximum number of elements in the distance matrix when
+    # assigning cases to clusters.
+    block_size = 1 << 20
+
+    def __init__(self, cases, keys=None):
+        # keys (the KeyIndex of the matcher) is not used; the cases
+        # with the keys of the query are found by the matcher itself.
+        self.cases = cases
+        self.columns = CaseColumns(cases)
+        self.axes = CaseTree.case_axes(cases)
+        self.categories = self._categories(self.columns)
+        points = self._points(self.columns)
+        self.centroids = self._train(points)
+        self.cluster_of = self._assign(points, self.centroids)
+        order = numpy.argsort(self.cluster_of, kind='stable')
+        bounds = numpy.searchsorted(self.cluster_of[order], numpy.arange(len(self.centroids)+1))
+        self.members = [order[bounds[c]:bounds[c+1]] for c in range(len(self.centroids))]
+
+    def _categories(self, columns):
+        """The value axes, as (attribute name, value, scale) tuples.
+        The attributes of the axes of the KD-tree and the key
+        attributes (see CaseTree.index_attributes) are left out."""
+        categories = []
+        names = set([name for (name,coordinate,scale) in self.axes] + list(CaseTree.index_attributes))
+        for name,column in sorted(columns.columns.items()):
+            if name in names:
+                continue
+            column._encode_numbers()
+            values = set()
+            for attr in column.values:
+                try:
+                    values.add(attr.value)
+                except TypeError:
+                    values = None
+                    break
+            if values and len(values) <= self.max_categories:
+                scale = type(column.values[0])._weight / numpy.sqrt(2.0)
+                categories.extend([(name, value, scale) for value in sorted(values)])
+        # The (start, stop) range of the axes of each attribute, and
+        # the axis of each of its values.
+        self._category_axes = {}
+        for axis,(name,value,scale) in enumerate(categories, len(self.axes)):
+            axes = self._category_axes.setdefault(name, [axis, axis+1, {}])
+            axes[1] = axis+1
+            axes[2][value] = axis
+        return categories
+
+    def _points(self, columns):
+        """Coordinates of the cases of columns, as a (cases x axes)
+        array. Missing values are placed at 0, as in the KD-tree."""
+        points = numpy.zeros((columns.size, len(self.axes)+len(self.categories)),
+                             dtype=numpy.float64)
+        for axis,(name,coordinate,scale) in enumerate(self.axes):
+            column = columns.columns.get(name)
+            if column is None:
+                continue
+            if coordinate is None and column.numbers is not None:
+                values = column.numbers.astype(numpy.float64)*scale
+            else:
+                column._encode_numbers()
+                table = numpy.array([CaseTree.coordinate(v, coordinate, scale) for v in column.values]
+                                    + [0.0], dtype=numpy.float64)
+                values = table[column.codes]
+            values[column.missing] = 0.0
+            points[:,axis] = values
+        for axis,(name,value,scale) in enumerate(self.categories, len(self.axes)):
+            column = columns.columns[name]
+            table = numpy.array([scale if v.value == value else 0.0 for v in column.values] + [0.0],
+                                dtype=numpy.float64)
+            points[:,axis] = table[column.codes]
+        return points
+
+    def _point(self, case):
+        """Coordinates of a case (or query), and a mask of the axes
+        of the attributes it has."""
+        point = numpy.zeros(len(self.axes)+len(self.categories), dtype=numpy.float64)
+        present = numpy.zeros(len(point), dtype=bool)
+        for axis,(name,coordinate,scale) in enumerate(self.axes):
+            if name in case:
+                point[axis] = CaseTree.coordinate(case[name], coordinate, scale)
+                present[axis] = True
+        for name,(start,stop,axes) in list(self._category_axes.items()):
+            if name in case:
+                present[start:stop] = True
+                try:
+                    axis = axes.get(case[name].value)
+                except TypeError:
+                    axis = None
+                if axis is not None:
+                    point[axis] = self.categories[axis-len(self.axes)][2]
+        return point, present
+
+    def _train(self, points):
+        """Centroids of the clusters, found by k-means on a sample of
+        the points. There are about the square root of the number of
+        cases; the random state is fixed, so the clusters of a case
+        base are always the same."""
+        size = len(points)
+        if not size:
+            return numpy.zeros((0, len(self.axes)+len(self.categories)), dtype=numpy.float64)
+        clusters = max(1, int(round(numpy.sqrt(size))))
+        random = numpy.random.RandomState(0)
+        if size > clusters*self.sample_factor:
+            points = points[random.choice(size, clusters*self.sample_factor, replace=False)]
+        centroids = points[random.choice(len(points), clusters, replace=False)]
+        for iteration in range(self.iterations):
+            assignment = self._assign(points, centroids)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, assignment, points)
+            counts = numpy.bincount(assignment, minlength=len(centroids))
+            # Empty clusters keep their centroid.
+            used = counts > 0
+            centroids[used] = sums[used] / counts[used][:,numpy.newaxis]
+        return centroids
+
+    def _assign(self, points, centroids):
+        """Number of the nearest centroid of each point, in blocks of
+        at most block_size distances."""
+        assignment = numpy.zeros(len(points), dtype=numpy.intp)
+        if not len(centroids):
+            return assignment
+        block = max(1, self.block_size // len(centroids))
+        squares = (centroids**2).sum(axis=1)
+        for start in range(0, len(points), block):
+            distances = squares - 2.0*numpy.dot(points[start:start+block], centroids.T)
+            assignment[start:start+block] = numpy.argmin(distances, axis=1)
+        return assignment
+
+    def _nearest(self, case):
+        point,present = self._point(case)
+        return int(self._assign(point[numpy.newaxis,:], self.centroids)[0])
+
+    def add(self, index, case):
+        """Add case number index, which must be the last case."""
+        self.columns.append(case)
+        if not len(self.centroids):
+            self.centroids = self._point(case)[0][numpy.newaxis,:]
+            self.members = [numpy.zeros(0, dtype=numpy.intp)]
+        cluster = self._nearest(case)
+        self.cluster_of = numpy.append(self.cluster_of, cluster)
+        self.members[cluster] = numpy.append(self.members[cluster], index)
+
+    def replace(self, index, case, old_case):
+        """Replace case number index (old_case) with case."""
+        self.columns.replace(index, case)
+        cluster = self._nearest(case)
+        if cluster != self.cluster_of[index]:
+            self._delete(index)
+            self.cluster_of[index] = cluster
+            self.members[cluster] = numpy.append(self.members[cluster], index)
+
+    def remove(self, index, case):
+        """Remove case number index (case). The cases after it move
+        down one index."""
+        self.columns.remove(index)
+        self._delete(index)
+        self.cluster_of = numpy.delete(self.cluster_of, index)
+        for members in self.members:
+            members[members > index] -= 1
+
+    def _delete(self, index):
+        """Remove case number index from its cluster, without moving
+        the other cases."""
+        cluster = self.cluster_of[index]
+        members = self.members[cluster]
+        self.members[cluster] = members[members != index]
+
+    def match(self, query, count, probes=1):
+        """Return the count best matches among the cases of the probes
+        clusters nearest to query (or of as many more as it takes to
+        compare count cases) as (similarity, index) tuples, ordered
+        the same way as Matcher.match()."""
+        if count <= 0 or not len(self.centroids):
+            return []
+        point,present = self._point(query)
+        distances = (((self.centroids - point)**2)*present).sum(axis=1)
+        order = numpy.argsort(distances, kind='stable')
+        # Enough clusters to have count cases, if there are more than
+        # probes.
+        sizes = numpy.cumsum([len(self.members[cluster]) for cluster in order])
+        probes = max(probes, int(numpy.searchsorted(sizes, count))+1)
+        indices = numpy.sort(numpy.concatenate([self.members[cluster] for cluster in order[:probes]]))
+        # Only the values of these cases are compared to the query.
+        similarities = self.columns.take(indices, query).similarity(query)
+        # The indices are in case base order, so best_indices() keeps
+        # cases with equal similarity in that order.
+        order = best_indices(similarities, count, count*8 < len(indices))
+        return [(float(similarities[i]), int(indices[i])) for i in order]
+
+def best_indices(similarities, count, partial=False):
+    """Indices of the count highest similarities, best first. Equal
+    similarities are ordered by index, like a stable sort.
+
+    If partial is set, numpy.argpartition is used to find the count
+    best values without sorting the whole array; only the values that
+    can make it into the result are sorted."""
+    if count <= 0:
+        return numpy.empty(0, dtype=numpy.intp)
+    negated = -similarities
+    if partial and count < len(similarities):
+        # The count'th best value is the threshold. Every value at
+        # least as good is a candidate, so ties at the threshold are
+        # resolved by index rather than by argpartition's choice.
+        threshold = negated[numpy.argpartition(negated, count-1)[count-1]]
+        candidates = numpy.flatnonzero(negated <= threshold)
+        order = numpy.argsort(negated[candidates], kind='stable')[:count]
+        return candidates[order]
+    # A stable sort on the negated similarities keeps cases with
+    # equal similarity in case base order, like sorted() does.
+    return numpy.argsort(negated, kind='stable')[:count]